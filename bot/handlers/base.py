@@ -1,15 +1,48 @@
+import asyncio
+import html
 import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
 from aiogram import Router, types, F
-from aiogram.filters import CommandStart, Command, or_f
+from aiogram.filters import CommandStart, Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from core.session_manager import session_manager
+from utils.ratelimit import send
 from bot.handlers.providers import build_providers_keyboard
 
 router = Router()
 logger = logging.getLogger("opencode_bot")
 
+# Last rendered (text hash, markup hash) per (chat_id, message_id), bounded LRU,
+# so menu edits that would not change anything can skip the API call
+MENU_RENDER_CACHE_SIZE = 1024
+_menu_renders: "OrderedDict[Tuple[int, int], Tuple[int, int]]" = OrderedDict()
+
+def _render_key(text: str, reply_markup: Optional[InlineKeyboardMarkup]) -> Tuple[int, int]:
+    return hash(text), hash(reply_markup.model_dump_json()) if reply_markup else 0
+
+def _remember_render(message: types.Message, render: Tuple[int, int]) -> None:
+    key = (message.chat.id, message.message_id)
+    _menu_renders[key] = render
+    _menu_renders.move_to_end(key)
+    if len(_menu_renders) > MENU_RENDER_CACHE_SIZE:
+        _menu_renders.popitem(last=False)
+
+async def _edit_menu(message: types.Message, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None, **kwargs) -> None:
+    """Edit a menu message, skipping the call when it already shows the same content
+    and sending only the keyboard when the text is unchanged"""
+    render = _render_key(text, reply_markup)
+    previous = _menu_renders.get((message.chat.id, message.message_id))
+    if previous == render:
+        return
+    if previous is not None and previous[0] == render[0]:
+        await send(lambda: message.edit_reply_markup(reply_markup=reply_markup), message.chat.id)
+    else:
+        await send(lambda: message.edit_text(text, reply_markup=reply_markup, **kwargs), message.chat.id)
+    _remember_render(message, render)
+
 def create_main_keyboard() -> InlineKeyboardMarkup:
     """Create main menu inline keyboard"""
     builder = InlineKeyboardBuilder()
@@ -24,213 +57,217 @@ def create_main_keyboard() -> InlineKeyboardMarkup:
     builder.adjust(2, 2, 2)
     return builder.as_markup()
 
+# Static content is built once at import and shared by all handlers
+MAIN_KEYBOARD = create_main_keyboard()
+
+QUESTION_KEYBOARD = (
+    InlineKeyboardBuilder()
+    .add(
+        InlineKeyboardButton(text="📝 Начать вопрос", callback_data="question:start"),
+        InlineKeyboardButton(text="⬅️ Назад", callback_data="menu:back")
+    )
+    .adjust(1)
+    .as_markup()
+)
+
+QUESTION_MENU_TEXT = (
+    "🧠 <b>Задать вопрос по коду</b>\n\n"
+    "Я могу помочь вам с:\n"
+    "• 📝 Объяснением кода\n"
+    "• 🚀 Улучшением кода\n"
+    "• 🔤 Переводом между языками\n"
+    "• 🧮 Объяснением алгоритмов\n"
+    "• 🐛 Поиском ошибок\n"
+    "• 🧪 Написанием тестов\n\n"
+    "Используйте команду /ask чтобы начать, или отправьте код с вопросом."
+)
+
+HELP_TEXT = (
+    "🤖 <b>Available Commands:</b>\n\n"
+    "📝 <b>Session Management</b>\n"
+    "/newsession - Start a new coding session\n"
+    "/listsessions - Show active sessions\n"
+    "/switchsession &lt;id&gt; - Switch context\n\n"
+    "💻 <b>Coding</b>\n"
+    "/generate - Generate code\n"
+    "/debug - Debug code\n"
+    "/refactor - Refactor code\n"
+    "/ask - Ask questions about code (interactive)\n\n"
+    "📁 <b>File Management</b>\n"
+    "/files - List files in current session\n"
+    "/view &lt;filename&gt; - View file content\n"
+    "/edit &lt;filename&gt; - Edit or create file\n"
+    "/publish - Publish session to GitHub\n\n"
+    "🤖 <b>AI Models</b>\n"
+    "/providers - Show available AI providers\n"
+    "/setprovider &lt;id&gt; - Set provider (use ID from /providers)\n"
+    "/setmodel &lt;provider&gt; &lt;model&gt; - Set specific model\n\n"
+    "⚙️ <b>Tools</b>\n"
+    "/settings - Toggle thinking display and publish\n"
+    "/cancel - Cancel current operation\n"
+    "/githubconnect - Connect GitHub account (coming soon)"
+)
+
+WELCOME_TEXT = (
+    "👋 Welcome to OpenCode AI Bot!\n\n"
+    "I am your bridge to the OpenCode coding agent.\n"
+    "Use кнопки ниже для быстрого доступа к функциям или /help для всех команд."
+)
+
+async def _send_help(target: types.Message, edit: bool) -> None:
+    """Send help text, editing the target message in place for menu callbacks"""
+    if edit:
+        await _edit_menu(target, HELP_TEXT, parse_mode="HTML", reply_markup=MAIN_KEYBOARD)
+    else:
+        sent = await send(lambda: target.answer(HELP_TEXT, parse_mode="HTML", reply_markup=MAIN_KEYBOARD), target.chat.id)
+        _remember_render(sent, _render_key(HELP_TEXT, MAIN_KEYBOARD))
+
+async def _send_welcome(target: types.Message, edit: bool) -> None:
+    """Send welcome text, editing the target message in place for menu callbacks"""
+    if edit:
+        await _edit_menu(target, WELCOME_TEXT, reply_markup=MAIN_KEYBOARD)
+    else:
+        sent = await send(lambda: target.answer(WELCOME_TEXT, reply_markup=MAIN_KEYBOARD), target.chat.id)
+        _remember_render(sent, _render_key(WELCOME_TEXT, MAIN_KEYBOARD))
+
 @router.message(CommandStart())
 async def cmd_start(message: types.Message):
-    logger.info(f"cmd_start called by user {message.from_user.id}")
-    keyboard = create_main_keyboard()
-    await message.answer(
-        "👋 Welcome to OpenCode AI Bot!\n\n"
-        "I am your bridge to the OpenCode coding agent.\n"
-        "Use кнопки ниже для быстрого доступа к функциям или /help для всех команд.",
-        reply_markup=keyboard
-    )
+    logger.info("cmd_start called by user %s", message.from_user.id)
+    await _send_welcome(message, edit=False)
 
 @router.message(Command("help"))
 async def cmd_help(message: types.Message):
-    help_text = (
-        "🤖 **Available Commands:**\n\n"
-        "📝 **Session Management**\n"
-        "/newsession - Start a new coding session\n"
-        "/listsessions - Show active sessions\n"
-        "/switchsession <id> - Switch context\n\n"
-        "💻 **Coding**\n"
-        "/generate - Generate code\n"
-        "/debug - Debug code\n"
-        "/refactor - Refactor code\n"
-        "/ask - Ask questions about code (interactive)\n\n"
-        "📁 **File Management**\n"
-        "/files - List files in current session\n"
-        "/view <filename> - View file content\n"
-        "/edit <filename> - Edit or create file\n"
-        "/publish - Publish session to GitHub\n\n"
-        "🤖 **AI Models**\n"
-        "/providers - Show available AI providers\n"
-        "/setprovider <id> - Set provider (use ID from /providers)\n"
-        "/setmodel <provider> <model> - Set specific model\n\n"
-        "⚙️ **Tools**\n"
-        "/settings - Toggle thinking display and publish\n"
-        "/cancel - Cancel current operation\n"
-        "/githubconnect - Connect GitHub account (coming soon)"
-    )
-    await message.answer(help_text, parse_mode="Markdown", reply_markup=create_main_keyboard())
+    await _send_help(message, edit=False)
 
-@router.message(or_f(Command("github_connect"), Command("githubconnect"), Command("gh")))
+@router.message(Command("github_connect", "githubconnect", "gh"))
 async def cmd_github_connect(message: types.Message):
-    await message.answer("GitHub integration coming soon!")
+    await send(lambda: message.answer("GitHub integration coming soon!"), message.chat.id)
 
-@router.callback_query(F.data == "menu:providers")
-async def callback_menu_providers(callback: CallbackQuery):
+async def _menu_providers(callback: CallbackQuery, message: types.Message, user_id: int) -> None:
     """Handle providers menu button"""
-    if callback.message is None:
-        await callback.answer()
-        return
-    message = callback.message
-    user_id = callback.from_user.id
     text, keyboard = await build_providers_keyboard(user_id)
-    if keyboard:
-        await message.edit_text(text, parse_mode="Markdown", reply_markup=keyboard)
-    else:
-        await message.edit_text(text, parse_mode="Markdown")
-    await callback.answer()
+    # Acknowledge the callback concurrently with the edit
+    await asyncio.gather(
+        _edit_menu(message, text, parse_mode="Markdown", reply_markup=keyboard),
+        callback.answer()
+    )
 
-@router.callback_query(F.data == "menu:newsession")
-async def callback_menu_newsession(callback: CallbackQuery):
+async def _menu_newsession(callback: CallbackQuery, message: types.Message, user_id: int) -> None:
     """Handle new session menu button"""
-    if callback.message is None:
-        await callback.answer()
-        return
-    message = callback.message
-    user_id = callback.from_user.id
     session_id = await session_manager.create_session(user_id)
-    await message.edit_text(
-        f"✅ Новая сессия создана!\nID: `{session_id}`\n\n"
-        "Теперь вы можете использовать команды /generate, /debug, /refactor.",
-        parse_mode="Markdown",
-        reply_markup=create_main_keyboard()
+    await asyncio.gather(
+        _edit_menu(
+            message,
+            f"✅ Новая сессия создана!\nID: <code>{session_id}</code>\n\n"
+            "Теперь вы можете использовать команды /generate, /debug, /refactor.",
+            parse_mode="HTML",
+            reply_markup=MAIN_KEYBOARD
+        ),
+        callback.answer()
     )
-    await callback.answer()
 
-@router.callback_query(F.data == "menu:listsessions")
-async def callback_menu_listsessions(callback: CallbackQuery):
+async def _menu_listsessions(callback: CallbackQuery, message: types.Message, user_id: int) -> None:
     """Handle list sessions menu button"""
-    if callback.message is None:
-        await callback.answer()
-        return
-    message = callback.message
-    user_id = callback.from_user.id
     sessions = await session_manager.list_user_sessions(user_id)
     
     if not sessions:
         text = "У вас нет активных сессий. Используйте «Новая сессия» чтобы начать."
-        await message.edit_text(text, reply_markup=create_main_keyboard())
-        await callback.answer()
+        await asyncio.gather(
+            _edit_menu(message, text, reply_markup=MAIN_KEYBOARD),
+            callback.answer()
+        )
         return
     
-    text = "📋 Ваши активные сессии:\n\n"
-    active_session = await session_manager.get_active_session(user_id)
-    active_session_id = active_session['id'] if active_session else None
+    active_session_id = session_manager.get_active_session_id(user_id)
     
-    for session in sessions:
-        session_id = session['id']
-        created = session['created_at'][:19]  # Trim microseconds
-        is_active = " ✅" if session_id == active_session_id else ""
-        text += f"• `{session_id}`\n  Создана: {created}{is_active}\n\n"
-    
-    text += "Используйте /switchsession <id> для переключения."
-    await message.edit_text(text, parse_mode="Markdown", reply_markup=create_main_keyboard())
-    await callback.answer()
+    # created_at is trimmed to drop microseconds
+    lines = [
+        f"• <code>{s['id']}</code>\n  Создана: {s['created_at'][:19]}{' ✅' if s['id'] == active_session_id else ''}\n\n"
+        for s in sessions
+    ]
+    text = "📋 Ваши активные сессии:\n\n" + "".join(lines) + "Используйте /switchsession &lt;id&gt; для переключения."
+    await asyncio.gather(
+        _edit_menu(message, text, parse_mode="HTML", reply_markup=MAIN_KEYBOARD),
+        callback.answer()
+    )
 
-@router.callback_query(F.data == "menu:help")
-async def callback_menu_help(callback: CallbackQuery):
+async def _menu_help(callback: CallbackQuery, message: types.Message, user_id: int) -> None:
     """Handle help menu button"""
-    if callback.message is None:
-        await callback.answer()
-        return
-    message = callback.message
-    help_text = (
-        "🤖 **Available Commands:**\n\n"
-        "📝 **Session Management**\n"
-        "/newsession - Start a new coding session\n"
-        "/listsessions - Show active sessions\n"
-        "/switchsession <id> - Switch context\n\n"
-        "💻 **Coding**\n"
-        "/generate - Generate code\n"
-        "/debug - Debug code\n"
-        "/refactor - Refactor code\n"
-        "/ask - Ask questions about code (interactive)\n\n"
-        "📁 **File Management**\n"
-        "/files - List files in current session\n"
-        "/view <filename> - View file content\n"
-        "/edit <filename> - Edit or create file\n"
-        "/publish - Publish session to GitHub\n\n"
-        "🤖 **AI Models**\n"
-        "/providers - Show available AI providers\n"
-        "/setprovider <id> - Set provider (use ID from /providers)\n"
-        "/setmodel <provider> <model> - Set specific model\n\n"
-        "⚙️ **Tools**\n"
-        "/settings - Toggle thinking display and publish\n"
-        "/cancel - Cancel current operation\n"
-        "/githubconnect - Connect GitHub account (coming soon)"
-    )
-    await message.edit_text(help_text, parse_mode="Markdown", reply_markup=create_main_keyboard())
-    await callback.answer()
+    await asyncio.gather(_send_help(message, edit=True), callback.answer())
 
-@router.callback_query(F.data == "menu:settings")
-async def callback_menu_settings(callback: CallbackQuery):
+async def _menu_settings(callback: CallbackQuery, message: types.Message, user_id: int) -> None:
     """Handle settings menu button"""
-    if callback.message is None:
-        await callback.answer()
-        return
-    message = callback.message
-    user_id = callback.from_user.id
-    user_prefs = await session_manager.get_user_preference(user_id)
+    user_prefs = session_manager.get_stored_preference(user_id)
+    if "provider_id" not in user_prefs:
+        user_prefs = await session_manager.get_user_preference(user_id)
     current_provider = user_prefs.get("provider_id", "OpenCode (auto)")
     current_model = user_prefs.get("model_id", "")
     
     text = (
-        f"⚙️ **Текущие настройки:**\n\n"
-        f"**Провайдер:** `{current_provider}`\n"
-        f"**Модель:** `{current_model}`\n\n"
+        f"⚙️ <b>Текущие настройки:</b>\n\n"
+        f"<b>Провайдер:</b> <code>{html.escape(current_provider)}</code>\n"
+        f"<b>Модель:</b> <code>{html.escape(current_model)}</code>\n\n"
         "Используйте «Выбор провайдера» для изменения настроек."
     )
-    await message.edit_text(text, parse_mode="Markdown", reply_markup=create_main_keyboard())
-    await callback.answer()
+    await asyncio.gather(
+        _edit_menu(message, text, parse_mode="HTML", reply_markup=MAIN_KEYBOARD),
+        callback.answer()
+    )
 
-@router.callback_query(F.data == "menu:question")
-async def callback_menu_question(callback: CallbackQuery):
+async def _menu_question(callback: CallbackQuery, message: types.Message, user_id: int) -> None:
     """Handle question menu button"""
-    if callback.message is None:
-        await callback.answer()
-        return
-    message = callback.message
-    user_id = callback.from_user.id
-    
-    text = (
-        "🧠 **Задать вопрос по коду**\n\n"
-        "Я могу помочь вам с:\n"
-        "• 📝 Объяснением кода\n"
-        "• 🚀 Улучшением кода\n"
-        "• 🔤 Переводом между языками\n"
-        "• 🧮 Объяснением алгоритмов\n"
-        "• 🐛 Поиском ошибок\n"
-        "• 🧪 Написанием тестов\n\n"
-        "Используйте команду /ask чтобы начать, или отправьте код с вопросом."
+    await asyncio.gather(
+        _edit_menu(message, QUESTION_MENU_TEXT, parse_mode="HTML", reply_markup=QUESTION_KEYBOARD),
+        callback.answer()
     )
-    
-    from aiogram.utils.keyboard import InlineKeyboardBuilder
-    from aiogram.types import InlineKeyboardButton
-    
-    builder = InlineKeyboardBuilder()
-    builder.add(
-        InlineKeyboardButton(text="📝 Начать вопрос", callback_data="question:start"),
-        InlineKeyboardButton(text="⬅️ Назад", callback_data="menu:back")
-    )
-    builder.adjust(1)
-    
-    await message.edit_text(text, parse_mode="Markdown", reply_markup=builder.as_markup())
-    await callback.answer()
 
-@router.callback_query(F.data == "menu:back")
-async def callback_menu_back(callback: CallbackQuery):
+async def _menu_back(callback: CallbackQuery, message: types.Message, user_id: int) -> None:
     """Return to main menu"""
-    if callback.message is None:
+    await asyncio.gather(_send_welcome(message, edit=True), callback.answer())
+
+# Main menu actions keyed by the part of callback_data after "menu:";
+# each receives the callback with its message and user id already bound
+MENU_HANDLERS: Dict[str, Callable[[CallbackQuery, types.Message, int], Awaitable[None]]] = {
+    "providers": _menu_providers,
+    "newsession": _menu_newsession,
+    "listsessions": _menu_listsessions,
+    "help": _menu_help,
+    "settings": _menu_settings,
+    "question": _menu_question,
+    "back": _menu_back,
+}
+MENU_CALLBACKS = frozenset(f"menu:{action}" for action in MENU_HANDLERS)
+
+# Menu presses from one user within this window are coalesced: only the latest
+# is rendered, earlier ones are just acknowledged
+MENU_DEBOUNCE_DELAY = 0.05  # seconds
+_pending_menu: Dict[int, asyncio.Task] = {}
+
+async def _run_menu_later(handler, callback: CallbackQuery, message: types.Message, user_id: int) -> None:
+    await asyncio.sleep(MENU_DEBOUNCE_DELAY)
+    # Once rendering starts the press can no longer be superseded
+    if _pending_menu.get(user_id) is asyncio.current_task():
+        del _pending_menu[user_id]
+    await handler(callback, message, user_id)
+
+@router.callback_query(F.data.in_(MENU_CALLBACKS))
+async def callback_menu(callback: CallbackQuery):
+    """Dispatch main menu buttons through a single filter"""
+    msg = callback.message
+    if msg is None:
         await callback.answer()
         return
-    message = callback.message
-    await message.edit_text(
-        "👋 Welcome to OpenCode AI Bot!\n\n"
-        "I am your bridge to the OpenCode coding agent.\n"
-        "Use кнопки ниже для быстрого доступа к функциим или /help для всех команд.",
-        reply_markup=create_main_keyboard()
-    )
-    await callback.answer()
+    handler = MENU_HANDLERS[callback.data.removeprefix("menu:")]
+    user_id = callback.from_user.id
+    
+    pending = _pending_menu.get(user_id)
+    if pending is not None:
+        pending.cancel()
+    task = asyncio.create_task(_run_menu_later(handler, callback, msg, user_id))
+    _pending_menu[user_id] = task
+    await asyncio.wait({task})
+    if task.cancelled():
+        # Superseded by a newer press before it was rendered
+        await callback.answer()
+    else:
+        task.result()
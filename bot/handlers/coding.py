@@ -1,45 +1,185 @@
-from aiogram import Router, types
+from aiogram import F, Router, types
 from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message, ContentType, InlineKeyboardMarkup, InlineKeyboardButton
-from typing import Dict, List
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 import logging
 import asyncio
-import time
+import codecs
+import html
+import os
+import tempfile
 from pathlib import Path
 
 from core.session_manager import session_manager
-from core.opencode_proxy import opencode_client
+from core.opencode_proxy import OpenCodeResult, opencode_client
 from core import session_files
 from core.archive_utils import ArchiveCreator
 from core.config import settings
-from aiogram.types import FSInputFile, BufferedInputFile
+from utils.ratelimit import send
+from utils.text import extract_fenced_code, split_code_into_parts, split_text_into_parts
+from aiogram.types import FSInputFile, InputMediaDocument
 
 router = Router()
 logger = logging.getLogger("opencode_bot")
 
-def split_text_into_parts(text, max_length=3500):
-    """Split text into parts, trying to break at sentence boundaries."""
-    parts = []
-    while len(text) > max_length:
-        # Find a good breaking point
-        split_at = max_length
-        # Try to break at sentence boundaries first
-        for separator in ['. ', '! ', '? ', '\n\n', '\n', ' ']:
-            pos = text.rfind(separator, 0, max_length)
-            if pos > 0 and pos > max_length * 0.7:  # Use at least 70% of limit
-                split_at = pos + len(separator)
-                break
+MIN_THINKING_INTERVAL = 0.3  # seconds
+THINKING_MAX_LENGTH = 3500  # Leave room for prefix and numbering
+QUESTION_PREFIX = "❓ *Question*"
+THINKING_PREFIX = "🤔 *Thinking*"
+QUESTION_PREFIX_N = "❓ *Question ({}/{})*"
+THINKING_PREFIX_N = "🤔 *Thinking ({}/{})*"
+
+
+class ThinkingStreamer:
+    """Relay OpenCode thinking blocks to the user through a single writer task.
+
+    Blocks are queued without waiting on Telegram; the writer appends whatever has
+    accumulated to the last thinking message (or starts a new one when it is full),
+    then waits min_interval before the next batch.
+    """
+    __slots__ = ('message', 'user_id', 'enabled', 'queue', 'writer', 'messages', 'min_interval',
+                 'current', 'current_text', 'current_question', 'last_block')
+
+    def __init__(self, message: Message, user_id: int, enabled: bool, min_interval: float = MIN_THINKING_INTERVAL):
+        self.message = message
+        self.user_id = user_id
+        self.enabled = enabled  # user's thinking display preference, read once per request
+        self.queue: "asyncio.Queue[Optional[str]]" = asyncio.Queue()  # None tells the writer to stop
+        self.writer: Optional[asyncio.Task] = None
+        self.messages: List[int] = []  # ids of sent thinking messages
+        self.min_interval = min_interval
+        # Last single-part thinking message, grown by editing while it has room
+        self.current: Optional[Message] = None
+        self.current_text = ""
+        self.current_question = False
+        # Previous raw block; the stream may resend it with more text appended
+        self.last_block = ""
+
+    async def __call__(self, thinking_text: str):
+        """Callback to handle thinking blocks from OpenCode"""
+        logger.debug("thinking_callback invoked: %d chars, preview: %.100s", len(thinking_text), thinking_text)
         
-        part = text[:split_at].strip()
-        if part:
-            parts.append(part)
-        text = text[split_at:].strip()
-    
-    if text:
-        parts.append(text)
-    return parts
+        # Check if thinking display is enabled
+        if not self.enabled:
+            logger.debug("thinking_callback: thinking display disabled for user")
+            return
+        
+        if not thinking_text:
+            logger.debug("thinking_callback: empty thinking text, returning")
+            return
+        
+        # Only relay what was appended since the previous block, not the whole prefix again
+        block = thinking_text
+        if self.last_block and thinking_text.startswith(self.last_block):
+            thinking_text = thinking_text[len(self.last_block):]
+        self.last_block = block
+        
+        thinking_text = thinking_text.strip()
+        if not thinking_text:
+            logger.debug("thinking_callback: empty thinking text, returning")
+            return
+        
+        # Log thinking to file
+        logger.info("Thinking: %.200s...", thinking_text)
+        
+        self.queue.put_nowait(thinking_text)
+        if self.writer is None:
+            self.writer = asyncio.create_task(self._write())
+
+    async def flush(self):
+        """Send everything still queued and stop the writer task."""
+        if self.writer is None:
+            return
+        self.queue.put_nowait(None)
+        await self.writer
+        self.writer = None
+
+    async def _write(self):
+        """Drain the queue, sending each batch of blocks as one message."""
+        loop = asyncio.get_running_loop()
+        while True:
+            blocks = [await self.queue.get()]
+            while not self.queue.empty():
+                blocks.append(self.queue.get_nowait())
+            closing = blocks[-1] is None
+            if closing:
+                blocks.pop()
+            started = loop.time()
+            if blocks:
+                await self._send("\n\n".join(blocks))
+            if closing:
+                return
+            # Only wait out what is left of the interval after the send itself
+            delay = self.min_interval - (loop.time() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def _send(self, thinking_display: str):
+        """Append thinking to the current message, or send it as new message(s) if it does not fit."""
+        # One scan of the whole text; parts only need their own check when it has a question mark
+        has_question = "?" in thinking_display
+        
+        if self.current is not None:
+            combined = f"{self.current_text}\n\n{thinking_display}"
+            if len(combined) <= THINKING_MAX_LENGTH:
+                combined_question = self.current_question or has_question
+                prefix = QUESTION_PREFIX if combined_question else THINKING_PREFIX
+                current = self.current
+                try:
+                    await send(lambda: current.edit_text(f"{prefix}: {combined}", parse_mode="Markdown"), self.message.chat.id)
+                    self.current_text = combined
+                    self.current_question = combined_question
+                    logger.debug("Appended thinking to message %s: %.100s...", current.message_id, thinking_display)
+                    return
+                except Exception as e:
+                    logger.warning(f"Failed to append to thinking message, sending a new one: {e}")
+            self.current = None
+        
+        if len(thinking_display) <= THINKING_MAX_LENGTH:
+            parts = (thinking_display,)
+        else:
+            parts = split_text_into_parts(thinking_display, THINKING_MAX_LENGTH)
+        n = len(parts)
+        
+        if n == 1:
+            prefix = QUESTION_PREFIX if has_question else THINKING_PREFIX
+            try:
+                thinking_msg = await send(lambda: self.message.answer(f"{prefix}: {thinking_display}", parse_mode="Markdown"), self.message.chat.id)
+            except Exception as e:
+                logger.warning(f"Failed to send thinking message: {e}")
+                return
+            self.messages.append(thinking_msg.message_id)
+            self.current = thinking_msg
+            self.current_text = thinking_display
+            self.current_question = has_question
+            logger.debug("Sent thinking: %.100s...", thinking_display)
+            return
+        
+        texts = []
+        for i, part in enumerate(parts):
+            # Number the parts; a part with a question mark gets the question prefix
+            if has_question and "?" in part:
+                prefix = QUESTION_PREFIX_N.format(i + 1, n)
+            else:
+                prefix = THINKING_PREFIX_N.format(i + 1, n)
+            texts.append(f"{prefix}: {part}")
+        
+        # Queue all parts at once; the per-chat limiter in send() admits them in order
+        chat_id = self.message.chat.id
+        sent = await asyncio.gather(
+            *(send(lambda text=text: self.message.answer(text, parse_mode="Markdown"), chat_id) for text in texts),
+            return_exceptions=True
+        )
+        for i, thinking_msg in enumerate(sent):
+            if isinstance(thinking_msg, Exception):
+                logger.warning(f"Failed to send thinking message part {i+1}: {thinking_msg}")
+            else:
+                self.messages.append(thinking_msg.message_id)
+                logger.debug("Sent thinking part %d/%d", i + 1, n)
+
+MEDIA_GROUP_SIZE = 10  # Telegram limit of documents per media group
 
 async def send_files_to_user(message: Message, session_folder: Path, files: Dict[str, List[str]]) -> None:
     """Send files to user via Telegram."""
@@ -50,16 +190,17 @@ async def send_files_to_user(message: Message, session_folder: Path, files: Dict
     all_files = files["all"]
     session_folder = Path(session_folder)
     
-    # Format file list for display
-    file_list_message = ArchiveCreator.format_file_list_for_display(files, session_folder)
-    if file_list_message:
-        await message.answer(file_list_message, parse_mode="Markdown")
-    
     # Send files based on count
     if len(all_files) <= settings.max_files_before_archive:
+        # Format file list for display
+        file_list_message = ArchiveCreator.format_file_list_for_display(files, session_folder)
+        if file_list_message:
+            await send(lambda: message.answer(file_list_message, parse_mode="Markdown"), message.chat.id)
         # Send individual files
         await _send_individual_files(message, session_folder, all_files)
     else:
+        # The archive caption lists the file count and size, so skip stat-ing every file for the list
+        await send(lambda: message.answer(f"📦 {len(all_files)} файлов будут отправлены архивом"), message.chat.id)
         # Send archive
         await _send_archive(message, session_folder, all_files)
 
@@ -73,16 +214,36 @@ async def _send_individual_files(message: Message, session_folder: Path, file_pa
     
     logger.info(f"Sending {len(files_to_send)} individual files to user {message.from_user.id}")
     
+    # Send files in albums of up to MEDIA_GROUP_SIZE documents, one API call each
+    for start in range(0, len(files_to_send), MEDIA_GROUP_SIZE):
+        group = files_to_send[start:start + MEDIA_GROUP_SIZE]
+        if len(group) < 2:  # a media group needs at least two items
+            await _send_documents(message, group)
+            continue
+        try:
+            media = [
+                InputMediaDocument(media=FSInputFile(str(abs_path), filename=abs_path.name), caption=f"`{rel_path}`")
+                for abs_path, rel_path in group
+            ]
+            await send(lambda: message.answer_media_group(media=media), message.chat.id)
+            logger.debug("Sent media group of %d files", len(group))
+        except Exception as e:
+            logger.error(f"Failed to send media group, sending files one by one: {e}")
+            await _send_documents(message, group)
+
+async def _send_documents(message: Message, files_to_send: List[Tuple[Path, str]]) -> None:
+    """Send files one document per message."""
     for abs_path, rel_path in files_to_send:
         try:
             # Send as document with caption showing relative path
-            await message.answer_document(
-                FSInputFile(str(abs_path), filename=abs_path.name),
-                caption=f"`{rel_path}`"
+            await send(
+                lambda: message.answer_document(
+                    FSInputFile(str(abs_path), filename=abs_path.name),
+                    caption=f"`{rel_path}`"
+                ),
+                message.chat.id
             )
-            logger.debug(f"Sent file: {rel_path}")
-            # Small delay to avoid rate limiting
-            await asyncio.sleep(0.5)
+            logger.debug("Sent file: %s", rel_path)
         except Exception as e:
             logger.error(f"Failed to send file {rel_path}: {e}")
 
@@ -90,27 +251,33 @@ async def _send_archive(message: Message, session_folder: Path, file_paths: List
     """Create and send ZIP archive of files."""
     logger.info(f"Creating archive for {len(file_paths)} files")
     
-    archive_buffer, archive_name, files_added = await ArchiveCreator.create_session_archive(
-        session_folder, file_paths
+    # Archive goes to a temporary file so it is streamed from disk rather than copied in memory
+    archive_path, archive_name, files_added = await ArchiveCreator.create_session_archive(
+        session_folder, file_paths, to_file=True
     )
     
-    if not archive_buffer or files_added == 0:
+    if not archive_path or files_added == 0:
         await message.answer("❌ Не удалось создать архив файлов.")
         return
     
-    archive_size = ArchiveCreator.get_archive_size(archive_buffer)
-    size_str = ArchiveCreator._format_size(archive_size)
-    
     try:
+        archive_size = os.path.getsize(archive_path)
+        size_str = ArchiveCreator._format_size(archive_size)
+        
         # Send archive as document
-        await message.answer_document(
-            BufferedInputFile(archive_buffer.getvalue(), filename=archive_name),
-            caption=f"📦 Архив сессии: {archive_name}\n📁 Файлов: {files_added}\n📊 Размер: {size_str}"
+        await send(
+            lambda: message.answer_document(
+                FSInputFile(archive_path, filename=archive_name),
+                caption=f"📦 Архив сессии: {archive_name}\n📁 Файлов: {files_added}\n📊 Размер: {size_str}"
+            ),
+            message.chat.id
         )
         logger.info(f"Sent archive '{archive_name}' with {files_added} files ({size_str})")
     except Exception as e:
         logger.error(f"Failed to send archive: {e}")
         await message.answer(f"❌ Ошибка при отправке архива: {str(e)[:200]}")
+    finally:
+        os.unlink(archive_path)
 
 class GenerateStates(StatesGroup):
     waiting_for_prompt = State()
@@ -123,9 +290,146 @@ class RefactorStates(StatesGroup):
     waiting_for_code = State()
     waiting_for_focus = State()
 
+TELEGRAM_MESSAGE_LIMIT = 4096
+TRUNCATED_MARK = "\n...truncated"
+
+def _code_block(body: str, lang: str = "python") -> str:
+    """Wrap body in an HTML code block, escaping it so Telegram cannot reject the markup."""
+    if lang:
+        return f'<pre><code class="language-{lang}">{html.escape(body, quote=False)}</code></pre>'
+    return f"<pre>{html.escape(body, quote=False)}</pre>"
+
+def _format_code_block(title: str, body: str, lang: str = "python") -> str:
+    """Render body as an HTML code block under title, truncated to fit a single Telegram message."""
+    # Telegram applies the limit after parsing, so tags and escapes do not count
+    budget = TELEGRAM_MESSAGE_LIMIT - len(title) - 2
+    if len(body) > budget:
+        body = body[:budget - len(TRUNCATED_MARK)] + TRUNCATED_MARK
+    return f"{title}\n\n{_code_block(body, lang)}"
+
+async def _send_code_block(message: Message, header: str, body: str, lang: str = "python") -> Message:
+    """Send body as an HTML code block, split into numbered messages if it exceeds Telegram's limit."""
+    if len(header) + len(body) + 2 <= TELEGRAM_MESSAGE_LIMIT:
+        text = _format_code_block(header, body, lang)
+        return await send(lambda: message.answer(text, parse_mode="HTML"), message.chat.id)
+    
+    # Split the raw text at line ends so no part ends inside an escape sequence
+    # and the parts put back together give the original code
+    parts = split_code_into_parts(body, 3500)
+    for i, part in enumerate(parts, 1):
+        text = f"{header} ({i}/{len(parts)})\n{_code_block(part, lang)}"
+        sent = await send(lambda: message.answer(text, parse_mode="HTML"), message.chat.id)
+    return sent
+
+async def _delete_status_message(status_message: Message) -> None:
+    """Delete the status message to avoid confusion, leaving it as is if that fails."""
+    try:
+        await status_message.delete()
+        logger.debug("Status message deleted")
+    except Exception as delete_error:
+        logger.debug("Could not delete status message: %s, leaving it as is", delete_error)
+
+async def _report_error(message: Message, status_message: Message, title: str, detail: str, hint: str = "") -> None:
+    """Show an error in the status message, falling back to a new message if it cannot be edited."""
+    body = _format_code_block(f"❌ <b>{title}</b>", detail[:500], lang="")
+    if hint:
+        body += f"\n\n{html.escape(hint, quote=False)}"
+    try:
+        await status_message.edit_text(body, parse_mode="HTML")
+    except Exception as edit_error:
+        logger.error(f"Failed to update error message: {edit_error}")
+        await message.answer(body, parse_mode="HTML")
+
+async def _session_id_from_state(message: Message, state: FSMContext, data: Dict) -> Optional[str]:
+    """Return the session id stored by the command handler, looking it up only if missing."""
+    session_id = data.get("session_id")
+    if session_id:
+        return session_id
+    
+    active_session = await session_manager.get_active_session(message.from_user.id)
+    if active_session is None:
+        await message.answer("Session expired. Use /newsession")
+        await state.clear()
+        return None
+    
+    if 'id' not in active_session:
+        logger.error(f"Active session missing 'id' key: {active_session}")
+        await message.answer("Session error: missing session ID.")
+        await state.clear()
+        return None
+    
+    return active_session['id']
+
+async def _run_opencode_task(message: Message, user_id: int, op: Callable[..., Awaitable[OpenCodeResult]], op_args: Tuple,
+                             status_text: str, success_title: str, error_title: str, error_hint: str, activity: str) -> None:
+    """
+    Run an OpenCode task, relaying thinking blocks, then deliver its answer and files.
+
+    Args:
+        message: Message that started the task
+        user_id: Telegram user ID
+        op: opencode_client method to call; the thinking streamer is passed as its last argument
+        op_args: Positional arguments for op, without the thinking callback
+        status_text: Text of the status message shown while the task runs
+        success_title: HTML title of the final answer
+        error_title: Title shown if the task fails
+        error_hint: Hint appended to the error when the call raises
+        activity: What the task does, for log messages (e.g. "generating code")
+    """
+    # Send initial message
+    status_message = await message.answer(status_text)
+    
+    # Relay thinking blocks to the chat
+    thinking_enabled = await session_manager.get_thinking_preference(user_id)
+    streamer = ThinkingStreamer(message, user_id, thinking_enabled)
+    
+    # Call OpenCode Proxy with error handling
+    try:
+        result = await op(*op_args, streamer)
+        await streamer.flush()
+    except Exception as e:
+        await streamer.flush()
+        logger.error(f"Error {activity}: {e}")
+        await _report_error(message, status_message, error_title, str(e), error_hint)
+        return
+    
+    # Process result
+    response_text = result.response
+    files = result.files
+    session_folder = result.session_folder
+    
+    if result.error:
+        logger.error(f"OpenCode returned error while {activity}: {response_text}")
+        await _report_error(message, status_message, error_title, response_text)
+        return
+    
+    # Send final result as new message (to appear after thinking blocks)
+    try:
+        # Send final result as new message while the status message is deleted
+        logger.debug("Sending final result as new message, result_length=%d", len(response_text))
+        _, final_message = await asyncio.gather(
+            _delete_status_message(status_message),
+            _send_code_block(message, success_title, response_text)
+        )
+        logger.debug("Final result sent as new message with message_id=%s", final_message.message_id)
+    except Exception as e:
+        logger.error(f"Failed to send final result: {e}")
+    
+    # Send created/modified files to user
+    if files.get("all") and session_folder:
+        try:
+            await send_files_to_user(message, session_folder, files)
+        except Exception as e:
+            logger.error(f"Failed to send files to user: {e}")
+            await message.answer(f"⚠️ Файлы созданы, но не удалось отправить: {str(e)[:200]}")
+    
+    # Log thinking messages count
+    if streamer.messages:
+        logger.info(f"Sent {len(streamer.messages)} thinking messages to user while {activity}")
+
 @router.message(Command("generate"))
 async def cmd_generate(message: types.Message, state: FSMContext):
-    logger.debug(f"INPUT: user_id={message.from_user.id}, chat_id={message.chat.id}, message_id={message.message_id}")
+    logger.debug("INPUT: user_id=%s, chat_id=%s, message_id=%s", message.from_user.id, message.chat.id, message.message_id)
     logger.info(f"CMD_GENERATE: user={message.from_user.id}")
     user_id = message.from_user.id
     active_session = await session_manager.get_active_session(user_id)
@@ -134,27 +438,25 @@ async def cmd_generate(message: types.Message, state: FSMContext):
         await message.answer("You need an active session. Use /newsession")
         return
 
+    # Remember the session so the follow-up handler does not look it up again
+    await state.update_data(session_id=active_session.get('id'))
     await message.answer("Describe the coding task you want me to solve:")
     await state.set_state(GenerateStates.waiting_for_prompt)
 
 @router.message(GenerateStates.waiting_for_prompt)
 async def process_generation_prompt(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    active_session = await session_manager.get_active_session(user_id)
-    logger.debug(f"INPUT: user_id={user_id}, message_text='{message.text[:100]}', session_exists={active_session is not None}")
+    data = await state.get_data()
+    logger.debug("INPUT: user_id=%s, message_text='%.100s', stored_session=%s", user_id, message.text or '', data.get('session_id'))
     logger.info(f"PROCESS_GENERATION_PROMPT: user={user_id}, prompt_length={len(message.text) if message.text else 0}")
-    if active_session is None or not message.text:
+    if not message.text:
         await message.answer("Session not found or invalid input.")
         await state.clear()
         return
     
-    assert active_session is not None
-    if 'id' not in active_session:
-        logger.error(f"Active session missing 'id' key: {active_session}")
-        await message.answer("Session error: missing session ID.")
-        await state.clear()
+    session_id = await _session_id_from_state(message, state, data)
+    if session_id is None:
         return
-    session_id = active_session['id']
     prompt = message.text
     
     # Get user provider/model preferences
@@ -193,162 +495,81 @@ async def process_generation_prompt(message: types.Message, state: FSMContext):
         await state.clear()
         return
 
-    # Send initial message
-    status_message = await message.answer(f"Generating code using {provider_id}/{model_id}... Please wait.")
-    
-    # Collect thinking blocks
-    thinking_messages = []
-    last_thinking_sent = 0.0
-    MIN_THINKING_INTERVAL = 0.3  # seconds
-    
-    async def thinking_callback(thinking_text: str):
-        """Callback to handle thinking blocks from OpenCode"""
-        nonlocal last_thinking_sent
-        
-        logger.debug(f"thinking_callback invoked: {len(thinking_text)} chars, preview: {thinking_text[:100]}")
-        
-        if not thinking_text or len(thinking_text.strip()) == 0:
-            logger.debug("thinking_callback: empty thinking text, returning")
-            return
-        
-        # Check if thinking display is enabled
-        if not await session_manager.get_thinking_preference(user_id):
-            return
-        
-        # Log thinking to file
-        logger.info(f"Thinking: {thinking_text[:200]}...")
-        
-        # Split long thinking into parts
-        thinking_display = thinking_text.strip()
-        max_length = 3500  # Leave room for prefix and numbering
-        
-        if len(thinking_display) <= max_length:
-            parts = [thinking_display]
-        else:
-            parts = split_text_into_parts(thinking_display, max_length)
-        
-        for i, part in enumerate(parts):
-            # Apply rate limiting for each part
-            current_time = time.time()
-            if current_time - last_thinking_sent < MIN_THINKING_INTERVAL:
-                logger.debug(f"Skipping thinking part {i+1}/{len(parts)} due to rate limit")
-                continue
-            
-            # Add part numbering if multiple parts
-            if "?" in part:
-                prefix = "❓ *Question*"
-                if len(parts) > 1:
-                    prefix = f"❓ *Question ({i+1}/{len(parts)})*"
-            else:
-                prefix = "🤔 *Thinking*"
-                if len(parts) > 1:
-                    prefix = f"🤔 *Thinking ({i+1}/{len(parts)})*"
-            
-            try:
-                thinking_msg = await message.answer(f"{prefix}: {part}", parse_mode="Markdown")
-                thinking_messages.append(thinking_msg.message_id)
-                last_thinking_sent = current_time
-                logger.debug(f"Sent thinking part {i+1}/{len(parts)}: {part[:100]}...")
-            except Exception as e:
-                logger.warning(f"Failed to send thinking message part {i+1}: {e}")
-    
-    # Call OpenCode Proxy with error handling
-    try:
-        result = await opencode_client.generate_code(prompt, "python", session_id, provider_id, model_id, thinking_callback)
-    except Exception as e:
-        logger.error(f"Error generating code: {e}")
-        try:
-            await status_message.edit_text(
-                f"❌ *Error Generating Code*\n\n"
-                f"```\n{str(e)[:500]}\n```\n\n"
-                f"Please try again or use a different prompt.",
-                parse_mode="Markdown"
-            )
-        except Exception as edit_error:
-            logger.error(f"Failed to update error message: {edit_error}")
-            await message.answer(f"❌ Error generating code: {str(e)[:200]}")
-        await state.clear()
-        return
-    
-    # Process result (now a dict with response and files)
-    if isinstance(result, dict):
-        response_text = result.get("response", "")
-        files = result.get("files", {})
-        session_folder = result.get("session_folder", "")
-        error_flag = result.get("error", False)
-        
-        if error_flag:
-            logger.error(f"OpenCode returned error: {response_text}")
-            try:
-                await status_message.edit_text(
-                    f"❌ *Error Generating Code*\n\n"
-                    f"```\n{response_text[:500]}\n```",
-                    parse_mode="Markdown"
-                )
-            except Exception as edit_error:
-                logger.error(f"Failed to update error message: {edit_error}")
-                await message.answer(f"❌ Error generating code: {response_text[:200]}")
-            await state.clear()
-            return
-    else:
-        # Backward compatibility: result is a string
-        response_text = str(result) if result else "No response received"
-        files = {"created": [], "modified": [], "all": []}
-        session_folder = ""
-        logger.warning(f"Received string result instead of dict, using backward compatibility")
-    
-    # Send final result as new message (to appear after thinking blocks)
-    try:
-        # Try to delete status message to avoid confusion
-        try:
-            await status_message.delete()
-            logger.debug(f"Status message deleted")
-        except Exception as delete_error:
-            logger.debug(f"Could not delete status message: {delete_error}, leaving it as is")
-        
-        # Send final result as new message
-        logger.debug(f"Sending final result as new message, result_length={len(response_text)}")
-        final_message = await message.answer(f"✅ *Code Generated*\n\n```python\n{response_text}\n```", parse_mode="Markdown")
-        logger.debug(f"Final result sent as new message with message_id={final_message.message_id}")
-    except Exception as e:
-        logger.error(f"Failed to send final result: {e}")
-        # Fallback: edit status message
-        try:
-            await status_message.edit_text(f"✅ *Code Generated*\n\n```python\n{response_text[:1000]}\n```", parse_mode="Markdown")
-            logger.debug(f"Fallback: edited status message")
-        except Exception as edit_error:
-            logger.error(f"Failed to update status message: {edit_error}")
-    
-    # Send created/modified files to user
-    if files.get("all") and session_folder:
-        try:
-            await send_files_to_user(message, session_folder, files)
-        except Exception as e:
-            logger.error(f"Failed to send files to user: {e}")
-            await message.answer(f"⚠️ Файлы созданы, но не удалось отправить: {str(e)[:200]}")
-    
-    # Log thinking messages count
-    if thinking_messages:
-        logger.info(f"Sent {len(thinking_messages)} thinking messages to user")
-    
+    await _run_opencode_task(
+        message, user_id, opencode_client.generate_code, (prompt, "python", session_id, provider_id, model_id),
+        f"Generating code using {provider_id}/{model_id}... Please wait.",
+        "✅ <b>Code Generated</b>", "Error Generating Code", "Please try again or use a different prompt.", "generating code"
+    )
     await state.clear()
 
-async def extract_code_from_message(message: Message) -> str:
-    """Extract code from various message types: text, document, reply."""
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+def _decode_text_file(path: str) -> str:
+    """Decode a downloaded file as UTF-8 in chunks, replacing invalid bytes."""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    chunks = []
+    with open(path, 'rb') as stream:
+        while chunk := stream.read(DOWNLOAD_CHUNK_SIZE):
+            chunks.append(decoder.decode(chunk))
+    chunks.append(decoder.decode(b'', final=True))
+    return ''.join(chunks)
+
+MAX_DOCUMENT_SIZE = 1024 * 1024  # bytes
+TEXT_EXTENSIONS = frozenset({'.py', '.txt', '.md'})
+UNSUPPORTED_DOCUMENT_TEXT = (
+    f"❌ Only text files up to {MAX_DOCUMENT_SIZE // 1024} KB can be read "
+    "(.py, .txt, .md or a text/* type)."
+)
+NO_CODE_TEXT = "Could not extract code from your message. Please try again."
+
+def is_text_document(document: types.Document) -> bool:
+    """Check from message metadata alone whether a document is a small text file worth downloading."""
+    if (document.file_size or 0) > MAX_DOCUMENT_SIZE:
+        return False
+    if document.mime_type:
+        return 'text' in document.mime_type
+    return Path(document.file_name or "").suffix.lower() in TEXT_EXTENSIONS
+
+async def read_text_document(message: Message) -> str:
+    """
+    Download the message's document and decode it as UTF-8, replacing invalid bytes.
+
+    Args:
+        message: Message with a document; callers check its size and type first
+
+    Returns:
+        Document text, or "" if Telegram gave no file path
+    """
+    assert message.bot is not None and message.document is not None
+    file = await message.bot.get_file(message.document.file_id)
+    if not file.file_path:
+        return ""
+    
+    # A file that fits in one chunk is simply read into memory
+    if message.document.file_size and message.document.file_size <= DOWNLOAD_CHUNK_SIZE:
+        buffer = await message.bot.download_file(file.file_path)
+        assert buffer is not None
+        return buffer.getvalue().decode('utf-8', errors='replace')
+    
+    # Downloading to a path lets aiogram write the file without blocking the event loop
+    fd, temp_path = tempfile.mkstemp(suffix=".download")
+    os.close(fd)
+    try:
+        await message.bot.download_file(file.file_path, destination=temp_path)
+        return await asyncio.to_thread(_decode_text_file, temp_path)
+    finally:
+        os.unlink(temp_path)
+
+async def _extract_one(message: Message) -> str:
+    """Extract code from a single message's document or text."""
     code = ""
     
     # Check for document (file upload)
     if message.document:
         # Only accept text files for now
-        if message.document.mime_type and 'text' in message.document.mime_type:
+        if is_text_document(message.document):
             try:
-                assert message.bot is not None
-                file = await message.bot.get_file(message.document.file_id)
-                if not file.file_path:
-                    return ""
-                file_bytes = await message.bot.download_file(file.file_path)
-                assert file_bytes is not None
-                code = file_bytes.read().decode('utf-8')
+                code = await read_text_document(message)
             except Exception as e:
                 logger.error(f"Error reading document: {e}")
                 return ""
@@ -361,27 +582,28 @@ async def extract_code_from_message(message: Message) -> str:
         
         # Check for code blocks in markdown (```python ... ```)
         if '```' in text:
-            # Extract code between first ``` and last ```
-            parts = text.split('```')
-            if len(parts) >= 3:
-                # Get the middle part (skip language specifier if present)
-                code_block = parts[1]
-                # Remove language specifier (e.g., "python\n")
-                lines = code_block.split('\n', 1)
-                if len(lines) > 1:
-                    code = lines[1]
-                else:
-                    code = code_block
+            # Extract the first fenced block, without its language specifier
+            code = extract_fenced_code(text) or ""
         else:
             # Use entire text as code
             code = text
     
-    # Check for reply to a message with code
-    elif message.reply_to_message:
-        return await extract_code_from_message(message.reply_to_message)
-    
     return code
 
+async def _answer_no_code(message: Message) -> None:
+    """Tell the user why no code was found, naming the file limits for a rejected document."""
+    if message.document and not is_text_document(message.document):
+        await message.answer(UNSUPPORTED_DOCUMENT_TEXT)
+    else:
+        await message.answer(NO_CODE_TEXT)
+
+async def extract_code_from_message(message: Message) -> str:
+    """Extract code from various message types: text, document, reply."""
+    # Walk the reply chain to the first message carrying a document or text
+    while not (message.document or message.text) and message.reply_to_message:
+        message = message.reply_to_message
+    return await _extract_one(message)
+
 @router.message(Command("debug"))
 async def cmd_debug(message: Message, state: FSMContext):
     logger.info(f"cmd_debug called by user {message.from_user.id}")
@@ -391,6 +613,7 @@ async def cmd_debug(message: Message, state: FSMContext):
     if active_session is None:
         await message.answer("You need an active session. Use /newsession")
         return
+    await state.update_data(session_id=active_session.get('id'))
     
     # Check if message contains code or is a reply to code
     code = await extract_code_from_message(message)
@@ -410,7 +633,7 @@ async def process_debug_code(message: Message, state: FSMContext):
     code = await extract_code_from_message(message)
     
     if not code:
-        await message.answer("Could not extract code from your message. Please try again.")
+        await _answer_no_code(message)
         return
     
     await state.update_data(debug_code=code)
@@ -434,161 +657,18 @@ async def process_debug_error(message: Message, state: FSMContext):
         return
     
     user_id = message.from_user.id
-    active_session = await session_manager.get_active_session(user_id)
-    if active_session is None:
-        await message.answer("Session expired. Use /newsession")
-        await state.clear()
+    session_id = await _session_id_from_state(message, state, data)
+    if session_id is None:
         return
-
-    if 'id' not in active_session:
-        logger.error(f"Active session missing 'id' key: {active_session}")
-        await message.answer("Session error: missing session ID.")
-        await state.clear()
-        return
-
-    session_id = active_session['id']
     user_prefs = await session_manager.get_user_preference(user_id)
     provider_id = user_prefs.get("provider_id", "")
     model_id = user_prefs.get("model_id", "")
     
-    # Send initial message
-    status_message = await message.answer(f"Debugging code using {provider_id}/{model_id}... Please wait.")
-    
-    # Collect thinking blocks
-    thinking_messages = []
-    last_thinking_sent = 0.0
-    MIN_THINKING_INTERVAL = 0.3  # seconds
-    
-    async def thinking_callback(thinking_text: str):
-        """Callback to handle thinking blocks from OpenCode"""
-        nonlocal last_thinking_sent
-        
-        logger.debug(f"thinking_callback invoked: {len(thinking_text)} chars, preview: {thinking_text[:100]}")
-        
-        if not thinking_text or len(thinking_text.strip()) == 0:
-            logger.debug("thinking_callback: empty thinking text, returning")
-            return
-        
-        # Check if thinking display is enabled
-        if not await session_manager.get_thinking_preference(user_id):
-            return
-        
-        # Log thinking to file
-        logger.info(f"Thinking: {thinking_text[:200]}...")
-        
-        # Split long thinking into parts
-        thinking_display = thinking_text.strip()
-        max_length = 3500  # Leave room for prefix and numbering
-        
-        if len(thinking_display) <= max_length:
-            parts = [thinking_display]
-        else:
-            parts = split_text_into_parts(thinking_display, max_length)
-        
-        for i, part in enumerate(parts):
-            # Apply rate limiting for each part
-            current_time = time.time()
-            if current_time - last_thinking_sent < MIN_THINKING_INTERVAL:
-                logger.debug(f"Skipping thinking part {i+1}/{len(parts)} due to rate limit")
-                continue
-            
-            # Add part numbering if multiple parts
-            if "?" in part:
-                prefix = "❓ *Question*"
-                if len(parts) > 1:
-                    prefix = f"❓ *Question ({i+1}/{len(parts)})*"
-            else:
-                prefix = "🤔 *Thinking*"
-                if len(parts) > 1:
-                    prefix = f"🤔 *Thinking ({i+1}/{len(parts)})*"
-            
-            try:
-                thinking_msg = await message.answer(f"{prefix}: {part}", parse_mode="Markdown")
-                thinking_messages.append(thinking_msg.message_id)
-                last_thinking_sent = current_time
-                logger.debug(f"Sent thinking part {i+1}/{len(parts)}: {part[:100]}...")
-            except Exception as e:
-                logger.warning(f"Failed to send thinking message part {i+1}: {e}")
-    
-    # Call OpenCode Proxy with error handling
-    try:
-        result = await opencode_client.debug_code(code, error_desc, session_id, provider_id, model_id, thinking_callback)
-    except Exception as e:
-        logger.error(f"Error debugging code: {e}")
-        try:
-            await status_message.edit_text(
-                f"❌ *Error Debugging Code*\n\n"
-                f"```\n{str(e)[:500]}\n```\n\n"
-                f"Please try again or check your code and error description.",
-                parse_mode="Markdown"
-            )
-        except Exception as edit_error:
-            logger.error(f"Failed to update error message: {edit_error}")
-            await message.answer(f"❌ Error debugging code: {str(e)[:200]}")
-        await state.clear()
-        return
-    
-    # Process result (now a dict with response and files)
-    if isinstance(result, dict):
-        response_text = result.get("response", "")
-        files = result.get("files", {})
-        session_folder = result.get("session_folder", "")
-        error_flag = result.get("error", False)
-        
-        if error_flag:
-            logger.error(f"OpenCode returned error during debugging: {response_text}")
-            try:
-                await status_message.edit_text(
-                    f"❌ *Error Debugging Code*\n\n"
-                    f"```\n{response_text[:500]}\n```",
-                    parse_mode="Markdown"
-                )
-            except Exception as edit_error:
-                logger.error(f"Failed to update error message: {edit_error}")
-                await message.answer(f"❌ Error debugging code: {response_text[:200]}")
-            await state.clear()
-            return
-    else:
-        # Backward compatibility: result is a string
-        response_text = str(result) if result else "No response received"
-        files = {"created": [], "modified": [], "all": []}
-        session_folder = ""
-        logger.warning(f"Received string result instead of dict, using backward compatibility")
-    
-    # Send final result as new message (to appear after thinking blocks)
-    try:
-        # Try to delete status message to avoid confusion
-        try:
-            await status_message.delete()
-            logger.debug(f"Status message deleted")
-        except Exception as delete_error:
-            logger.debug(f"Could not delete status message: {delete_error}, leaving it as is")
-        
-        # Send final result as new message
-        logger.debug(f"Sending final debug result as new message, result_length={len(response_text)}")
-        final_message = await message.answer(f"✅ *Debug Result*\n\n```python\n{response_text}\n```", parse_mode="Markdown")
-        logger.debug(f"Final debug result sent as new message with message_id={final_message.message_id}")
-    except Exception as e:
-        logger.error(f"Failed to send final debug result: {e}")
-        # Fallback: edit status message
-        try:
-            await status_message.edit_text(f"✅ *Debug Result*\n\n```python\n{response_text[:1000]}\n```", parse_mode="Markdown")
-            logger.debug(f"Fallback: edited status message")
-        except Exception as edit_error:
-            logger.error(f"Failed to update status message: {edit_error}")
-    
-    # Send created/modified files to user
-    if files.get("all") and session_folder:
-        try:
-            await send_files_to_user(message, session_folder, files)
-        except Exception as e:
-            logger.error(f"Failed to send files to user: {e}")
-            await message.answer(f"⚠️ Файлы созданы, но не удалось отправить: {str(e)[:200]}")
-    
-    # Log thinking messages count
-    if thinking_messages:
-        logger.info(f"Sent {len(thinking_messages)} thinking messages to user during debugging")
-    
+    await _run_opencode_task(
+        message, user_id, opencode_client.debug_code, (code, error_desc, session_id, provider_id, model_id),
+        f"Debugging code using {provider_id}/{model_id}... Please wait.",
+        "✅ <b>Debug Result</b>", "Error Debugging Code", "Please try again or check your code and error description.", "debugging code"
+    )
     await state.clear()
 
 @router.message(Command("refactor"))
@@ -600,6 +680,7 @@ async def cmd_refactor(message: Message, state: FSMContext, command: CommandObje
     if active_session is None:
         await message.answer("You need an active session. Use /newsession")
         return
+    await state.update_data(session_id=active_session.get('id'))
     
     # Check for focus area in command arguments
     focus = command.args if command and command.args else ""
@@ -629,7 +710,7 @@ async def process_refactor_code_input(message: Message, state: FSMContext):
     code = await extract_code_from_message(message)
     
     if not code:
-        await message.answer("Could not extract code from your message. Please try again.")
+        await _answer_no_code(message)
         return
     
     await state.update_data(refactor_code=code)
@@ -665,170 +746,23 @@ async def process_refactor_code(message: Message, state: FSMContext):
         return
     
     user_id = message.from_user.id
-    active_session = await session_manager.get_active_session(user_id)
-    if active_session is None:
-        await message.answer("Session expired. Use /newsession")
-        await state.clear()
-        return
-
-    if 'id' not in active_session:
-        logger.error(f"Active session missing 'id' key: {active_session}")
-        await message.answer("Session error: missing session ID.")
-        await state.clear()
+    session_id = await _session_id_from_state(message, state, data)
+    if session_id is None:
         return
-
-    session_id = active_session['id']
     user_prefs = await session_manager.get_user_preference(user_id)
     provider_id = user_prefs.get("provider_id", "")
     model_id = user_prefs.get("model_id", "")
 
-    # Send initial message
-    status_message = await message.answer(f"Refactoring code using {provider_id}/{model_id}... Please wait.")
-    
-    # Collect thinking blocks
-    thinking_messages = []
-    last_thinking_sent = 0.0
-    MIN_THINKING_INTERVAL = 0.3  # seconds
-    
-    async def thinking_callback(thinking_text: str):
-        """Callback to handle thinking blocks from OpenCode"""
-        nonlocal last_thinking_sent
-        
-        logger.debug(f"thinking_callback invoked: {len(thinking_text)} chars, preview: {thinking_text[:100]}")
-        
-        if not thinking_text or len(thinking_text.strip()) == 0:
-            logger.debug("thinking_callback: empty thinking text, returning")
-            return
-        
-        # Check if thinking display is enabled
-        if not await session_manager.get_thinking_preference(user_id):
-            return
-        
-        # Log thinking to file
-        logger.info(f"Thinking: {thinking_text[:200]}...")
-        
-        # Split long thinking into parts
-        thinking_display = thinking_text.strip()
-        max_length = 3500  # Leave room for prefix and numbering
-        
-        if len(thinking_display) <= max_length:
-            parts = [thinking_display]
-        else:
-            parts = split_text_into_parts(thinking_display, max_length)
-        
-        for i, part in enumerate(parts):
-            # Apply rate limiting for each part
-            current_time = time.time()
-            if current_time - last_thinking_sent < MIN_THINKING_INTERVAL:
-                logger.debug(f"Skipping thinking part {i+1}/{len(parts)} due to rate limit")
-                continue
-            
-            # Add part numbering if multiple parts
-            if "?" in part:
-                prefix = "❓ *Question*"
-                if len(parts) > 1:
-                    prefix = f"❓ *Question ({i+1}/{len(parts)})*"
-            else:
-                prefix = "🤔 *Thinking*"
-                if len(parts) > 1:
-                    prefix = f"🤔 *Thinking ({i+1}/{len(parts)})*"
-            
-            try:
-                thinking_msg = await message.answer(f"{prefix}: {part}", parse_mode="Markdown")
-                thinking_messages.append(thinking_msg.message_id)
-                last_thinking_sent = current_time
-                logger.debug(f"Sent thinking part {i+1}/{len(parts)}: {part[:100]}...")
-            except Exception as e:
-                logger.warning(f"Failed to send thinking message part {i+1}: {e}")
-    
-    # Call OpenCode Proxy with error handling
-    try:
-        result = await opencode_client.refactor_code(code, focus, session_id, provider_id, model_id, thinking_callback)
-    except Exception as e:
-        logger.error(f"Error refactoring code: {e}")
-        try:
-            await status_message.edit_text(
-                f"❌ *Error Refactoring Code*\n\n"
-                f"```\n{str(e)[:500]}\n```\n\n"
-                f"Please try again or check your code and focus description.",
-                parse_mode="Markdown"
-            )
-        except Exception as edit_error:
-            logger.error(f"Failed to update error message: {edit_error}")
-            await message.answer(f"❌ Error refactoring code: {str(e)[:200]}")
-        await state.clear()
-        return
-    
-    # Process result (now a dict with response and files)
-    if isinstance(result, dict):
-        response_text = result.get("response", "")
-        files = result.get("files", {})
-        session_folder = result.get("session_folder", "")
-        error_flag = result.get("error", False)
-        
-        if error_flag:
-            logger.error(f"OpenCode returned error during refactoring: {response_text}")
-            try:
-                await status_message.edit_text(
-                    f"❌ *Error Refactoring Code*\n\n"
-                    f"```\n{response_text[:500]}\n```",
-                    parse_mode="Markdown"
-                )
-            except Exception as edit_error:
-                logger.error(f"Failed to update error message: {edit_error}")
-                await message.answer(f"❌ Error refactoring code: {response_text[:200]}")
-            await state.clear()
-            return
-    else:
-        # Backward compatibility: result is a string
-        response_text = str(result) if result else "No response received"
-        files = {"created": [], "modified": [], "all": []}
-        session_folder = ""
-        logger.warning(f"Received string result instead of dict, using backward compatibility")
-    
-    # Send final result as new message (to appear after thinking blocks)
-    try:
-        # Try to delete status message to avoid confusion
-        try:
-            await status_message.delete()
-            logger.debug(f"Status message deleted")
-        except Exception as delete_error:
-            logger.debug(f"Could not delete status message: {delete_error}, leaving it as is")
-        
-        # Send final result as new message
-        logger.debug(f"Sending final refactored result as new message, result_length={len(response_text)}")
-        final_message = await message.answer(f"✅ *Refactored Code*\n\n```python\n{response_text}\n```", parse_mode="Markdown")
-        logger.debug(f"Final refactored result sent as new message with message_id={final_message.message_id}")
-    except Exception as e:
-        logger.error(f"Failed to send final refactored result: {e}")
-        # Fallback: edit status message
-        try:
-            await status_message.edit_text(f"✅ *Refactored Code*\n\n```python\n{response_text[:1000]}\n```", parse_mode="Markdown")
-            logger.debug(f"Fallback: edited status message")
-        except Exception as edit_error:
-            logger.error(f"Failed to update status message: {edit_error}")
-    
-    # Send created/modified files to user
-    if files.get("all") and session_folder:
-        try:
-            await send_files_to_user(message, session_folder, files)
-        except Exception as e:
-            logger.error(f"Failed to send files to user: {e}")
-            await message.answer(f"⚠️ Файлы созданы, но не удалось отправить: {str(e)[:200]}")
-    
-    # Log thinking messages count
-    if thinking_messages:
-        logger.info(f"Sent {len(thinking_messages)} thinking messages to user during refactoring")
-    
+    await _run_opencode_task(
+        message, user_id, opencode_client.refactor_code, (code, focus, session_id, provider_id, model_id),
+        f"Refactoring code using {provider_id}/{model_id}... Please wait.",
+        "✅ <b>Refactored Code</b>", "Error Refactoring Code", "Please try again or check your code and focus description.", "refactoring code"
+    )
     await state.clear()
 
-@router.message(Command("settings"))
-async def cmd_settings(message: types.Message):
-    """Show settings menu for thinking display"""
-    user_id = message.from_user.id
-    show_thinking = await session_manager.get_thinking_preference(user_id)
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+def _settings_keyboard(show_thinking: bool) -> InlineKeyboardMarkup:
+    """Build the /settings keyboard for one thinking display state."""
+    return InlineKeyboardMarkup(inline_keyboard=[
         [
             InlineKeyboardButton(
                 text="✅ Thinking Display ON" if show_thinking else "❌ Thinking Display OFF",
@@ -842,6 +776,26 @@ async def cmd_settings(message: types.Message):
             )
         ]
     ])
+
+# The settings keyboard only depends on the thinking flag, so both variants are built once
+_SETTINGS_KB_ON = _settings_keyboard(True)
+_SETTINGS_KB_OFF = _settings_keyboard(False)
+
+# All sessions are published into the same local clone, so git runs one publish at a time
+_publish_lock = asyncio.Lock()
+
+async def _publish_session(session_id: str) -> Dict:
+    """Publish a session to GitHub in a worker thread, keeping the event loop free during git."""
+    async with _publish_lock:
+        return await asyncio.to_thread(session_files.publish_to_github, session_id)
+
+@router.message(Command("settings"))
+async def cmd_settings(message: types.Message):
+    """Show settings menu for thinking display"""
+    user_id = message.from_user.id
+    show_thinking = await session_manager.get_thinking_preference(user_id)
+    
+    keyboard = _SETTINGS_KB_ON if show_thinking else _SETTINGS_KB_OFF
     
     status_text = "ON" if show_thinking else "OFF"
     active_session = await session_manager.get_active_session(user_id)
@@ -855,33 +809,22 @@ async def cmd_settings(message: types.Message):
         reply_markup=keyboard
     )
 
-@router.callback_query(lambda c: c.data == "toggle_thinking")
+@router.callback_query(F.data == "toggle_thinking")
 async def toggle_thinking_callback(callback_query: types.CallbackQuery):
     """Toggle thinking display preference"""
     user_id = callback_query.from_user.id
     current = await session_manager.get_thinking_preference(user_id)
     new_setting = not current
+    
     await session_manager.set_thinking_preference(user_id, new_setting)
+    # The session id is only shown, so the session itself is not loaded
+    active_session_id = session_manager.get_active_session_id(user_id)
     
     # Update button text
-    active_session = await session_manager.get_active_session(user_id)
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(
-                text="✅ Thinking Display ON" if new_setting else "❌ Thinking Display OFF",
-                callback_data="toggle_thinking"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                text="📤 Publish Session to GitHub",
-                callback_data="publish_session"
-            )
-        ]
-    ])
+    keyboard = _SETTINGS_KB_ON if new_setting else _SETTINGS_KB_OFF
     
     status_text = "ON" if new_setting else "OFF"
-    session_id_short = active_session['id'][:8] if active_session else 'None'
+    session_id_short = active_session_id[:8] if active_session_id else 'None'
     await callback_query.message.edit_text(
         f"⚙️ *Settings*\n\n"
         f"• Thinking Display: {status_text}\n\n"
@@ -892,7 +835,7 @@ async def toggle_thinking_callback(callback_query: types.CallbackQuery):
     )
     await callback_query.answer(f"Thinking display turned {status_text}")
 
-@router.callback_query(lambda c: c.data == "publish_session")
+@router.callback_query(F.data == "publish_session")
 async def publish_session_callback(callback_query: types.CallbackQuery):
     """Publish current session to GitHub from settings"""
     user_id = callback_query.from_user.id
@@ -921,25 +864,12 @@ async def publish_session_callback(callback_query: types.CallbackQuery):
     )
     
     # Publish to GitHub
-    result = session_files.publish_to_github(session_id)
+    result = await _publish_session(session_id)
     
     if result.get("success"):
         files = result.get("files_copied", [])
         # Update settings message with success
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(
-                    text="✅ Thinking Display ON" if await session_manager.get_thinking_preference(user_id) else "❌ Thinking Display OFF",
-                    callback_data="toggle_thinking"
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    text="📤 Publish Session to GitHub",
-                    callback_data="publish_session"
-                )
-            ]
-        ])
+        keyboard = _SETTINGS_KB_ON if await session_manager.get_thinking_preference(user_id) else _SETTINGS_KB_OFF
         
         await callback_query.message.edit_text(
             f"⚙️ *Settings*\n\n"
@@ -963,21 +893,19 @@ async def publish_session_callback(callback_query: types.CallbackQuery):
         )
         await callback_query.answer("Publish failed", show_alert=True)
 
-@router.message(Command("start"))
-async def cmd_start(message: types.Message):
-    """Send welcome message"""
-    await message.answer("Hello Klavdii is work!")
+def _read_version() -> str:
+    """Read the deployed version; VERSION only changes on deployment."""
+    version_file = Path("VERSION")
+    if version_file.exists():
+        return version_file.read_text().strip()
+    return "unknown"
+
+VERSION_TEXT = f"Klavdii Bot Version: {_read_version()}"
 
 @router.message(Command("version"))
 async def cmd_version(message: types.Message):
     """Show bot version"""
-    version_file = Path("VERSION")
-    if version_file.exists():
-        version = version_file.read_text().strip()
-    else:
-        version = "unknown"
-    
-    await message.answer(f"Klavdii Bot Version: {version}")
+    await message.answer(VERSION_TEXT)
 
 @router.message(Command("publish"))
 async def cmd_publish(message: types.Message):
@@ -1000,7 +928,7 @@ async def cmd_publish(message: types.Message):
     status_msg = await message.answer(f"📤 Publishing session {session_id[:8]}... Please wait.")
     
     # Publish to GitHub
-    result = session_files.publish_to_github(session_id)
+    result = await _publish_session(session_id)
     
     if result.get("success"):
         files = result.get("files_copied", [])
@@ -1020,7 +948,7 @@ async def cmd_publish(message: types.Message):
             parse_mode="Markdown"
         )
 
-@router.message(lambda message: message.text and not message.text.startswith('/'))
+@router.message(F.text & ~F.text.startswith('/'))
 async def handle_text_message(message: types.Message, state: FSMContext):
     """Handle regular text messages as code generation requests"""
     # Check if we're in a state (waiting for input)
@@ -1049,139 +977,8 @@ async def handle_text_message(message: types.Message, state: FSMContext):
     prompt = message.text
     session_id = active_session['id']
     
-    # Send initial message
-    status_message = await message.answer(f"Generating code from your request using {provider_id}/{model_id}... Please wait.")
-    
-    # Collect thinking blocks
-    thinking_messages = []
-    last_thinking_sent = 0.0
-    MIN_THINKING_INTERVAL = 0.3  # seconds
-    
-    async def thinking_callback(thinking_text: str):
-        """Callback to handle thinking blocks from OpenCode"""
-        nonlocal last_thinking_sent
-        
-        logger.debug(f"thinking_callback invoked: {len(thinking_text)} chars, preview: {thinking_text[:100]}")
-        
-        if not thinking_text or len(thinking_text.strip()) == 0:
-            logger.debug("thinking_callback: empty thinking text, returning")
-            return
-        
-        # Check if thinking display is enabled
-        if not await session_manager.get_thinking_preference(user_id):
-            logger.debug("thinking_callback: thinking display disabled for user")
-            return
-        
-        # Log thinking to file
-        logger.info(f"Thinking: {thinking_text[:200]}...")
-        
-        # Split long thinking into parts
-        thinking_display = thinking_text.strip()
-        max_length = 3500  # Leave room for prefix and numbering
-        
-        if len(thinking_display) <= max_length:
-            parts = [thinking_display]
-        else:
-            parts = split_text_into_parts(thinking_display, max_length)
-        
-        for i, part in enumerate(parts):
-            # Apply rate limiting for each part
-            current_time = time.time()
-            if current_time - last_thinking_sent < MIN_THINKING_INTERVAL:
-                logger.debug(f"Skipping thinking part {i+1}/{len(parts)} due to rate limit")
-                continue
-            
-            # Add part numbering if multiple parts
-            if "?" in part:
-                prefix = "❓ *Question*"
-                if len(parts) > 1:
-                    prefix = f"❓ *Question ({i+1}/{len(parts)})*"
-            else:
-                prefix = "🤔 *Thinking*"
-                if len(parts) > 1:
-                    prefix = f"🤔 *Thinking ({i+1}/{len(parts)})*"
-            
-            try:
-                thinking_msg = await message.answer(f"{prefix}: {part}", parse_mode="Markdown")
-                thinking_messages.append(thinking_msg.message_id)
-                last_thinking_sent = current_time
-                logger.debug(f"Sent thinking part {i+1}/{len(parts)}: {part[:100]}...")
-            except Exception as e:
-                logger.warning(f"Failed to send thinking message part {i+1}: {e}")
-    
-    # Call OpenCode Proxy with error handling
-    try:
-        result = await opencode_client.generate_code(prompt, "python", session_id, provider_id, model_id, thinking_callback)
-    except Exception as e:
-        logger.error(f"Error generating code: {e}")
-        try:
-            await status_message.edit_text(
-                f"❌ *Error Generating Code*\n\n"
-                f"```\n{str(e)[:500]}\n```\n\n"
-                f"Please try again or use a different prompt.",
-                parse_mode="Markdown"
-            )
-        except Exception as edit_error:
-            logger.error(f"Failed to update error message: {edit_error}")
-            await message.answer(f"❌ Error generating code: {str(e)[:200]}")
-        return
-    
-    # Process result (now a dict with response and files)
-    if isinstance(result, dict):
-        response_text = result.get("response", "")
-        files = result.get("files", {})
-        session_folder = result.get("session_folder", "")
-        error_flag = result.get("error", False)
-        
-        if error_flag:
-            logger.error(f"OpenCode returned error: {response_text}")
-            try:
-                await status_message.edit_text(
-                    f"❌ *Error Generating Code*\n\n"
-                    f"```\n{response_text[:500]}\n```",
-                    parse_mode="Markdown"
-                )
-            except Exception as edit_error:
-                logger.error(f"Failed to update error message: {edit_error}")
-                await message.answer(f"❌ Error generating code: {response_text[:200]}")
-            return
-    else:
-        # Backward compatibility: result is a string
-        response_text = str(result) if result else "No response received"
-        files = {"created": [], "modified": [], "all": []}
-        session_folder = ""
-        logger.warning(f"Received string result instead of dict, using backward compatibility")
-    
-    # Send final result as new message (to appear after thinking blocks)
-    try:
-        # Try to delete status message to avoid confusion
-        try:
-            await status_message.delete()
-            logger.debug(f"Status message deleted")
-        except Exception as delete_error:
-            logger.debug(f"Could not delete status message: {delete_error}, leaving it as is")
-        
-        # Send final result as new message
-        logger.debug(f"Sending final result as new message, result_length={len(response_text)}")
-        final_message = await message.answer(f"✅ *Code Generated*\n\n```python\n{response_text}\n```", parse_mode="Markdown")
-        logger.debug(f"Final result sent as new message with message_id={final_message.message_id}")
-    except Exception as e:
-        logger.error(f"Failed to send final result: {e}")
-        # Fallback: edit status message
-        try:
-            await status_message.edit_text(f"✅ *Code Generated*\n\n```python\n{response_text[:1000]}\n```", parse_mode="Markdown")
-            logger.debug(f"Fallback: edited status message")
-        except Exception as edit_error:
-            logger.error(f"Failed to update status message: {edit_error}")
-    
-    # Send created/modified files to user
-    if files.get("all") and session_folder:
-        try:
-            await send_files_to_user(message, session_folder, files)
-        except Exception as e:
-            logger.error(f"Failed to send files to user: {e}")
-            await message.answer(f"⚠️ Файлы созданы, но не удалось отправить: {str(e)[:200]}")
-    
-    # Log thinking messages count
-    if thinking_messages:
-        logger.info(f"Sent {len(thinking_messages)} thinking messages to user")
+    await _run_opencode_task(
+        message, user_id, opencode_client.generate_code, (prompt, "python", session_id, provider_id, model_id),
+        f"Generating code from your request using {provider_id}/{model_id}... Please wait.",
+        "✅ <b>Code Generated</b>", "Error Generating Code", "Please try again or use a different prompt.", "generating code"
+    )
@@ -3,8 +3,11 @@ from aiogram.filters import Command, or_f
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-from aiogram.utils.keyboard import InlineKeyboardBuilder
+import asyncio
+from functools import lru_cache
+from itertools import islice
 import logging
+from typing import Any, Dict, Optional, Tuple
 
 from core.session_manager import session_manager
 from core.opencode_proxy import opencode_client
@@ -16,6 +19,118 @@ class ProviderStates(StatesGroup):
     choosing_provider = State()
     choosing_model = State()
 
+CURRENT_MARK = "✅ "  # prefix of the button for the current selection
+PROVIDER_PREFIX = "provider:"  # callback data prefix of provider buttons
+
+NO_PROVIDERS_TEXT = (
+    "⚠️ No connected providers found in OpenCode.\n\n"
+    "Please connect a provider in OpenCode first:\n"
+    "1. Open OpenCode TUI: `opencode`\n"
+    "2. Use `/connect` command\n"
+    "3. Choose a provider (e.g., OpenCode Zen, OpenAI, Anthropic)\n"
+    "4. Configure API key\n"
+    "5. Restart the bot"
+)
+PROVIDER_NOT_FOUND_TEXT = "❌ Provider not found."
+NO_MODELS_TEXT = "❌ Provider has no models."
+
+# Validation errors, shown as-is in callback alerts
+PROVIDER_UNAVAILABLE = "❌ Provider not available"
+PROVIDER_HAS_NO_MODELS = "❌ Provider has no models"
+MODEL_NOT_FOUND = "❌ Model not found"
+
+ProviderChoices = Tuple[Tuple[str, str], ...]  # (id, name) of each connected provider
+
+# (providers response, connected providers by id, their choices) for the last response indexed
+_connected_index: Optional[Tuple[Dict[str, Any], Dict[str, Dict[str, Any]], ProviderChoices]] = None
+
+async def _index_connected() -> Tuple[Dict[str, Dict[str, Any]], ProviderChoices]:
+    """Index connected providers by id, in OpenCode's order, once per providers response."""
+    global _connected_index
+    providers_data = await opencode_client.get_providers()
+    cached = _connected_index
+    if cached is not None and cached[0] is providers_data:
+        return cached[1], cached[2]
+    
+    connected = set(providers_data.get("connected", []))
+    by_id = {p["id"]: p for p in providers_data.get("all", []) if p["id"] in connected}
+    choices = tuple((p["id"], p["name"]) for p in by_id.values())
+    _connected_index = (providers_data, by_id, choices)
+    return by_id, choices
+
+async def get_connected_providers() -> Dict[str, Dict[str, Any]]:
+    """Return connected providers by id, in OpenCode's order."""
+    return (await _index_connected())[0]
+
+
+CALLBACK_DATA_LIMIT = 64  # bytes Telegram accepts in a button's callback data
+
+
+def _button(text: str, callback_data: str) -> Optional[InlineKeyboardButton]:
+    """Create a callback button, skipping pydantic validation.
+
+    Provider and model ids come from OpenCode, so callback data built from them may exceed
+    Telegram's limit; such a button is logged and None is returned so the caller leaves it out.
+    """
+    if len(callback_data.encode()) > CALLBACK_DATA_LIMIT:
+        logger.warning("Skipping button %r: callback data %r exceeds %d bytes", text, callback_data, CALLBACK_DATA_LIMIT)
+        return None
+    return InlineKeyboardButton.model_construct(text=text, callback_data=callback_data)
+
+
+@lru_cache(maxsize=256)
+def _providers_markup(choices: ProviderChoices, current_provider: str) -> InlineKeyboardMarkup:
+    """Build the providers keyboard; the same menu is shown again and again, so it is cached."""
+    rows = []
+    for provider_id, provider_name in choices:
+        button = _button(
+            CURRENT_MARK + provider_name if provider_id == current_provider else provider_name,
+            PROVIDER_PREFIX + provider_id
+        )
+        if button is not None:
+            rows.append([button])
+    return InlineKeyboardMarkup.model_construct(inline_keyboard=rows)
+
+
+@lru_cache(maxsize=256)
+def _models_markup(provider_id: str, model_ids: Tuple[str, ...], current_model: str) -> InlineKeyboardMarkup:
+    """Build a provider's models keyboard with a back button; cached like _providers_markup."""
+    rows = []
+    for model_id in model_ids:
+        button = _button(
+            CURRENT_MARK + model_id if model_id == current_model else model_id,
+            f"model:{provider_id}:{model_id}"
+        )
+        if button is not None:
+            rows.append([button])
+    rows.append([_button("⬅️ Back to providers", "providers:back")])
+    return InlineKeyboardMarkup.model_construct(inline_keyboard=rows)
+
+
+async def _validate_provider_model(provider_id: str, model_id: Optional[str] = None) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """
+    Check that a provider is connected and has the requested model.
+
+    Args:
+        provider_id: Provider to look up
+        model_id: Model that must exist; if None, the provider only needs to have some model
+
+    Returns:
+        (provider_info, error): provider_info is None only if the provider is not connected;
+        error is PROVIDER_UNAVAILABLE, PROVIDER_HAS_NO_MODELS, MODEL_NOT_FOUND or None
+    """
+    provider_info = (await get_connected_providers()).get(provider_id)
+    if not provider_info:
+        return None, PROVIDER_UNAVAILABLE
+    
+    models = provider_info.get("models", {})
+    if model_id is None:
+        if not models:
+            return provider_info, PROVIDER_HAS_NO_MODELS
+    elif model_id not in models:
+        return provider_info, MODEL_NOT_FOUND
+    return provider_info, None
+
 
 async def build_providers_keyboard(user_id: int) -> tuple[str, InlineKeyboardMarkup | None]:
     """Build providers list text and inline keyboard."""
@@ -23,91 +138,51 @@ async def build_providers_keyboard(user_id: int) -> tuple[str, InlineKeyboardMar
     current_provider = user_prefs.get("provider_id", "OpenCode (auto)")
     current_model = user_prefs.get("model_id", "")
     
-    # Get providers from OpenCode
-    providers_data = await opencode_client.get_providers()
-    all_providers = providers_data.get("all", [])
-    connected = providers_data.get("connected", [])
+    # Get connected providers from OpenCode
+    _, choices = await _index_connected()
     
-    # Filter to show only connected providers
-    connected_providers = [p for p in all_providers if p["id"] in connected]
+    logger.info("build_providers_keyboard: user=%s, current_provider=%s, connected_count=%d", user_id, current_provider, len(choices))
+    for provider_id, provider_name in choices[:10]:  # Log first 10 connected providers
+        logger.debug("Connected provider: id=%s, name=%s", provider_id, provider_name)
     
-    logger.info(f"build_providers_keyboard: user={user_id}, current_provider={current_provider}, connected_count={len(connected_providers)}")
-    for p in connected_providers[:10]:  # Log first 10 connected providers
-        logger.info(f"Connected provider: id={p.get('id')}, name={p.get('name')}")
-    
-    if not connected_providers:
-        text = (
-            "⚠️ No connected providers found in OpenCode.\n\n"
-            "Please connect a provider in OpenCode first:\n"
-            "1. Open OpenCode TUI: `opencode`\n"
-            "2. Use `/connect` command\n"
-            "3. Choose a provider (e.g., OpenCode Zen, OpenAI, Anthropic)\n"
-            "4. Configure API key\n"
-            "5. Restart the bot"
-        )
-        return text, None
+    if not choices:
+        return NO_PROVIDERS_TEXT, None
     
     text = f"**Current selection:** `{current_provider}` / `{current_model}`\n\n"
     text += "**Select a provider:**\n"
     
-    builder = InlineKeyboardBuilder()
-    
-    for provider in connected_providers:
-        provider_id = provider["id"]
-        provider_name = provider["name"]
-        is_current = "✅ " if provider_id == current_provider else ""
-        builder.add(InlineKeyboardButton(
-            text=f"{is_current}{provider_name}",
-            callback_data=f"provider:{provider_id}"
-        ))
-    
-    builder.adjust(1)  # One button per row
-    
-    return text, builder.as_markup()
+    return text, _providers_markup(choices, current_provider)
 
 
-async def build_models_keyboard(user_id: int, provider_id: str) -> tuple[str, InlineKeyboardMarkup | None]:
-    """Build models list for a provider."""
-    user_prefs = await session_manager.get_user_preference(user_id)
-    current_model = user_prefs.get("model_id", "")
+async def build_models_keyboard(user_id: int, provider_id: str, provider_info: Optional[Dict[str, Any]] = None,
+                                current_model: Optional[str] = None) -> tuple[str, InlineKeyboardMarkup | None]:
+    """Build models list for a provider; callers that already hold the provider info or model skip their lookups.
+
+    A current_model passed in is taken to belong to provider_id; a looked-up one is only
+    checkmarked in the keyboard when the user's current provider is provider_id.
+    """
+    marked_model = current_model
+    if current_model is None:
+        user_prefs = await session_manager.get_user_preference(user_id)
+        current_model = user_prefs.get("model_id", "")
+        marked_model = current_model if user_prefs.get("provider_id") == provider_id else ""
     
     # Get provider info
-    providers_data = await opencode_client.get_providers()
-    all_providers = providers_data.get("all", [])
-    connected = providers_data.get("connected", [])
-    
-    provider_info = None
-    for p in all_providers:
-        if p["id"] == provider_id and p["id"] in connected:
-            provider_info = p
-            break
-    
+    if provider_info is None:
+        provider_info = (await get_connected_providers()).get(provider_id)
     if not provider_info:
-        return "❌ Provider not found.", None
+        return PROVIDER_NOT_FOUND_TEXT, None
     
     models = provider_info.get("models", {})
     if not models:
-        return "❌ Provider has no models.", None
+        return NO_MODELS_TEXT, None
     
+    # The current model is named in the text as well, since its button may be
+    # left out of the keyboard when its callback data is too long
     text = f"**Select model for {provider_info['name']}:**\n"
     text += f"Current model: `{current_model}`\n\n"
     
-    builder = InlineKeyboardBuilder()
-    
-    for model_id in models.keys():
-        is_current = "✅ " if model_id == current_model else ""
-        builder.add(InlineKeyboardButton(
-            text=f"{is_current}{model_id}",
-            callback_data=f"model:{provider_id}:{model_id}"
-        ))
-    
-    builder.add(InlineKeyboardButton(
-        text="⬅️ Back to providers",
-        callback_data="providers:back"
-    ))
-    builder.adjust(1)
-    
-    return text, builder.as_markup()
+    return text, _models_markup(provider_id, tuple(models), marked_model)
 
 
 @router.message(or_f(Command("providers"), Command("provider"), Command("model")))
@@ -121,7 +196,7 @@ async def cmd_providers(message: types.Message):
     else:
         await message.answer(text, parse_mode="Markdown")
 
-@router.callback_query(F.data.startswith("provider:"))
+@router.callback_query(F.data.startswith(PROVIDER_PREFIX))
 async def callback_provider_selection(callback: CallbackQuery):
     """Handle provider selection from inline keyboard"""
     if callback.message is None:
@@ -131,43 +206,24 @@ async def callback_provider_selection(callback: CallbackQuery):
     if callback.data is None:
         await callback.answer("❌ Invalid data", show_alert=True)
         return
-    provider_id = callback.data.split(":", 1)[1]
+    provider_id = callback.data[len(PROVIDER_PREFIX):]
     user_id = callback.from_user.id
     
-    # Get provider info
-    providers_data = await opencode_client.get_providers()
-    all_providers = providers_data.get("all", [])
-    connected = providers_data.get("connected", [])
-    
-    logger.info(f"Provider selection: user={user_id}, requested provider={provider_id}")
-    logger.info(f"Connected providers: {connected}")
-    logger.info(f"All providers count: {len(all_providers)}")
-    
     # Validate provider
-    provider_info = None
-    for p in all_providers:
-        if p["id"] == provider_id:
-            logger.info(f"Found provider {provider_id}: connected={p['id'] in connected}")
-            if p["id"] in connected:
-                provider_info = p
-                break
-    
-    if not provider_info:
-        await callback.answer("❌ Provider not available", show_alert=True)
-        return
-    
-    # Get models for this provider
-    models = provider_info.get("models", {})
-    if not models:
-        await callback.answer("❌ Provider has no models", show_alert=True)
+    provider_info, error = await _validate_provider_model(provider_id)
+    logger.info("Provider selection: user=%s, requested provider=%s, error=%s", user_id, provider_id, error)
+    if error:
+        await callback.answer(error, show_alert=True)
         return
     
     # Set default model (first one)
-    model_id = list(models.keys())[0]
-    await session_manager.set_user_preference(user_id, provider_id, model_id)
+    model_id = next(iter(provider_info["models"]))
     
-    # Show model selection keyboard
-    text, keyboard = await build_models_keyboard(user_id, provider_id)
+    # Save it while the model selection keyboard is built from the provider already looked up
+    _, (text, keyboard) = await asyncio.gather(
+        session_manager.set_user_preference(user_id, provider_id, model_id),
+        build_models_keyboard(user_id, provider_id, provider_info, model_id)
+    )
     if keyboard:
         await message.edit_text(text, parse_mode="Markdown", reply_markup=keyboard)
     else:
@@ -186,44 +242,39 @@ async def callback_model_selection(callback: CallbackQuery):
     if callback.data is None:
         await callback.answer("❌ Invalid data", show_alert=True)
         return
-    data_parts = callback.data.split(":")
+    # Model ids may contain colons themselves, so split off only the prefix and provider id
+    data_parts = callback.data.split(":", 2)
     if len(data_parts) != 3:
         await callback.answer("❌ Invalid data", show_alert=True)
         return
     
-    provider_id = data_parts[1]
-    model_id = data_parts[2]
+    _, provider_id, model_id = data_parts
     user_id = callback.from_user.id
     
     # Validate provider and model
-    providers_data = await opencode_client.get_providers()
-    all_providers = providers_data.get("all", [])
-    connected = providers_data.get("connected", [])
-    
-    provider_info = None
-    for p in all_providers:
-        if p["id"] == provider_id and p["id"] in connected:
-            provider_info = p
-            break
-    
-    if not provider_info:
-        await callback.answer("❌ Provider not available", show_alert=True)
+    provider_info, error = await _validate_provider_model(provider_id, model_id)
+    if error:
+        await callback.answer(error, show_alert=True)
         return
     
-    models = provider_info.get("models", {})
-    if model_id not in models:
-        await callback.answer("❌ Model not found", show_alert=True)
+    # Nothing to save or redraw if this model is already selected
+    current = session_manager.get_stored_preference(user_id)
+    if current.get("provider_id") == provider_id and current.get("model_id") == model_id:
+        await callback.answer(f"✅ Selected {model_id}")
         return
     
-    # Save preferences
-    await session_manager.set_user_preference(user_id, provider_id, model_id)
-    
-    # Show updated model list
-    text, keyboard = await build_models_keyboard(user_id, provider_id)
-    if keyboard:
-        await message.edit_text(text, parse_mode="Markdown", reply_markup=keyboard)
+    text, keyboard = await build_models_keyboard(user_id, provider_id, provider_info, model_id)
+    if current.get("model_id") != model_id:
+        # The "Current model" line changes along with the checkmark
+        edit = message.edit_text(text, parse_mode="Markdown", reply_markup=keyboard)
     else:
-        await message.edit_text(text, parse_mode="Markdown")
+        # Same model id under another provider: the text is unchanged, only the checkmark moves
+        edit = message.edit_reply_markup(reply_markup=keyboard)
+    # Save preferences while the model list is updated
+    await asyncio.gather(
+        session_manager.set_user_preference(user_id, provider_id, model_id),
+        edit
+    )
     
     await callback.answer(f"✅ Selected {model_id}")
 
@@ -247,7 +298,7 @@ async def callback_back_to_providers(callback: CallbackQuery):
 @router.message(Command("setprovider"))
 async def cmd_setprovider(message: types.Message):
     """Set provider for current user"""
-    args = message.text.split()
+    args = message.text.split(maxsplit=2)
     if len(args) < 2:
         # Show providers keyboard instead of usage text
         await cmd_providers(message)
@@ -256,32 +307,20 @@ async def cmd_setprovider(message: types.Message):
     provider_id = args[1]
     user_id = message.from_user.id
     
-    # Get providers to validate
-    providers_data = await opencode_client.get_providers()
-    all_providers = providers_data.get("all", [])
-    connected = providers_data.get("connected", [])
-    
-    # Check if provider exists and is connected
-    provider_info = None
-    for p in all_providers:
-        if p["id"] == provider_id and p["id"] in connected:
-            provider_info = p
-            break
-    
-    if not provider_info:
+    # Check if provider exists, is connected and has models
+    provider_info, error = await _validate_provider_model(provider_id)
+    if error == PROVIDER_UNAVAILABLE:
         await message.answer(
             f"❌ Provider `{provider_id}` not found or not connected.\n"
             "Use `/providers` to see available providers."
         )
         return
-    
-    # Get first model from provider as default
-    models = provider_info.get("models", {})
-    if not models:
+    if error:
         await message.answer(f"❌ Provider `{provider_id}` has no models available.")
         return
     
-    model_id = list(models.keys())[0]
+    # Get first model from provider as default
+    model_id = next(iter(provider_info["models"]))
     
     # Save preferences
     await session_manager.set_user_preference(user_id, provider_id, model_id)
@@ -295,7 +334,7 @@ async def cmd_setprovider(message: types.Message):
 @router.message(Command("setmodel"))
 async def cmd_setmodel(message: types.Message):
     """Set specific model for current provider"""
-    args = message.text.split()
+    args = message.text.split(maxsplit=3)
     if len(args) < 3:
         # Show providers keyboard instead of usage text
         await cmd_providers(message)
@@ -305,31 +344,21 @@ async def cmd_setmodel(message: types.Message):
     model_id = args[2]
     user_id = message.from_user.id
     
-    # Get providers to validate
-    providers_data = await opencode_client.get_providers()
-    all_providers = providers_data.get("all", [])
-    connected = providers_data.get("connected", [])
-    
-    # Check if provider exists and is connected
-    provider_info = None
-    for p in all_providers:
-        if p["id"] == provider_id and p["id"] in connected:
-            provider_info = p
-            break
-    
-    if not provider_info:
+    # Check if provider exists and is connected, and has the model
+    provider_info, error = await _validate_provider_model(provider_id, model_id)
+    if error == PROVIDER_UNAVAILABLE:
         await message.answer(
             f"❌ Provider `{provider_id}` not found or not connected.\n"
             "Use `/providers` to see available providers."
         )
         return
     
-    # Check if model exists
-    models = provider_info.get("models", {})
-    if model_id not in models:
-        available_models = ", ".join(list(models.keys())[:5])
-        if len(models) > 5:
-            available_models += f" ... and {len(models)-5} more"
+    if error:
+        models = provider_info.get("models", {})
+        available_models = ", ".join(islice(models, 5))
+        model_count = len(models)
+        if model_count > 5:
+            available_models += f" ... and {model_count - 5} more"
         
         await message.answer(
             f"❌ Model `{model_id}` not found in provider `{provider_id}`.\n"
@@ -6,12 +6,12 @@ from aiogram import Router, types, F
 from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, FSInputFile
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from typing import Dict, List, Optional, Tuple, cast
+from typing import Callable, Dict, List, Optional, Tuple, cast
 import logging
 import asyncio
-import time
+import os
 from pathlib import Path
 
 from core.session_manager import session_manager
@@ -19,6 +19,10 @@ from core.opencode_proxy import opencode_client
 from core.archive_utils import ArchiveCreator
 from core.file_tracker import FileChangeTracker
 from core import session_files
+from utils.ratelimit import send
+from utils.text import extract_fenced_code, split_text_into_parts
+from bot.handlers.coding import UNSUPPORTED_DOCUMENT_TEXT, is_text_document, read_text_document
+from bot.handlers.coding import send_files_to_user as coding_send_files
 
 router = Router()
 logger = logging.getLogger("opencode_bot")
@@ -61,8 +65,30 @@ QUESTION_CATEGORIES = {
     }
 }
 
+CATEGORY_PREFIX = "question_category:"
 
-async def build_question_categories_keyboard() -> InlineKeyboardMarkup:
+
+def _compile_template(template: str) -> Callable[[str], str]:
+    """Turn a template whose only field is {code} into a plain concatenation."""
+    head, _, tail = template.partition("{code}")
+    return lambda code: head + code + tail
+
+
+def _compile_renderers() -> Dict[str, Callable[[str], str]]:
+    """Renderers for the categories whose template has {code} as its only field."""
+    renderers = {}
+    for category_id, category_info in QUESTION_CATEGORIES.items():
+        template = category_info["template"]
+        if template and template.count("{") == 1:
+            renderers[category_id] = _compile_template(template)
+    return renderers
+
+
+# Templates are fixed per category, so their renderers are prepared once
+_CATEGORY_RENDERERS = _compile_renderers()
+
+
+def _build_categories_markup() -> InlineKeyboardMarkup:
     """Build keyboard with question categories."""
     builder = InlineKeyboardBuilder()
     
@@ -70,7 +96,7 @@ async def build_question_categories_keyboard() -> InlineKeyboardMarkup:
         builder.add(
             InlineKeyboardButton(
                 text=category_info["name"],
-                callback_data=f"question_category:{category_id}"
+                callback_data=CATEGORY_PREFIX + category_id
             )
         )
     
@@ -78,42 +104,79 @@ async def build_question_categories_keyboard() -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
-async def build_followup_questions_keyboard(session_id: str, files: Dict[str, List[str]]) -> Optional[InlineKeyboardMarkup]:
-    """Build follow-up question suggestions based on generated files."""
-    if not files.get("all"):
-        return None
-    
+# Common follow-up questions
+FOLLOWUP_QUESTIONS = [
+    ("📁 Показать все файлы", "show_files"),
+    ("📦 Скачать архив", "download_archive"),
+    ("📝 Объяснить код", "explain_code"),
+    ("🐛 Отладить код", "debug_code"),
+    ("🚀 Оптимизировать", "optimize_code"),
+    ("🧪 Добавить тесты", "add_tests"),
+]
+
+
+def _build_followup_markup() -> InlineKeyboardMarkup:
+    """Build keyboard with follow-up question suggestions."""
     builder = InlineKeyboardBuilder()
     
-    # Common follow-up questions
-    followup_questions = [
-        ("📁 Показать все файлы", "show_files"),
-        ("📦 Скачать архив", "download_archive"),
-        ("📝 Объяснить код", "explain_code"),
-        ("🐛 Отладить код", "debug_code"),
-        ("🚀 Оптимизировать", "optimize_code"),
-        ("🧪 Добавить тесты", "add_tests"),
-    ]
-    
-    for text, action in followup_questions:
+    for text, action in FOLLOWUP_QUESTIONS:
         builder.add(InlineKeyboardButton(text=text, callback_data=f"followup:{action}"))
     
     builder.adjust(2)
     return builder.as_markup()
 
 
+# Both keyboards are fixed, so they are built once at import
+_CATEGORIES_MARKUP = _build_categories_markup()
+_FOLLOWUP_MARKUP = _build_followup_markup()
+
+
+async def build_question_categories_keyboard() -> InlineKeyboardMarkup:
+    """Return keyboard with question categories."""
+    return _CATEGORIES_MARKUP
+
+
+async def build_followup_questions_keyboard(session_id: str, files: Dict[str, List[str]]) -> Optional[InlineKeyboardMarkup]:
+    """Return follow-up question suggestions if files were generated."""
+    if not files.get("all"):
+        return None
+    return _FOLLOWUP_MARKUP
+
+
+ASK_HELP_TEXT = (
+    "📝 **Задайте вопрос по коду**\n\n"
+    "Отправьте мне код, а затем выберите тип вопроса.\n"
+    "Вы можете:\n"
+    "1. Отправить код в сообщении с ``` блоками\n"
+    "2. Отправить .py файл\n"
+    "3. Ответить на сообщение с кодом командой /ask\n\n"
+    "Или используйте /cancel чтобы отменить."
+)
+CUSTOM_QUESTION_TEXT = (
+    "💭 **Свой вопрос**\n\n"
+    "%s\n\n"
+    "Теперь напишите свой вопрос по этому коду:"
+)
+TRANSLATE_QUESTION_TEXT = (
+    "🔤 **Перевод кода**\n\n"
+    "%s\n\n"
+    "С какого языка перевести и на какой?\n"
+    "Пример: 'с Python на JavaScript' или 'с JavaScript на Python'"
+)
+PREVIEW_LENGTH = 200
+_PREVIEW_TEMPLATE = "```python\n%s%s\n```"
+
+
+def _code_preview(code: str) -> str:
+    """Fenced preview of the first PREVIEW_LENGTH characters of code."""
+    return _PREVIEW_TEMPLATE % (code[:PREVIEW_LENGTH], '...' if len(code) > PREVIEW_LENGTH else '')
+
+
 def extract_code_from_text(text: str) -> str:
     """Extract code from text (handles code blocks)."""
-    if '```' in text:
-        parts = text.split('```')
-        if len(parts) >= 3:
-            code_block = parts[1]
-            # Remove language specifier
-            lines = code_block.split('\n', 1)
-            if len(lines) > 1:
-                return lines[1].strip()
-            return code_block.strip()
-    return text.strip()
+    # The first fenced block, without its language specifier, or else the whole text
+    code = extract_fenced_code(text)
+    return (text if code is None else code).strip()
 
 
 async def send_files_to_user(message: types.Message, session_folder: str, files: Dict[str, List[str]]) -> None:
@@ -121,7 +184,6 @@ async def send_files_to_user(message: types.Message, session_folder: str, files:
     if not files.get("all"):
         return
     
-    from bot.handlers.coding import send_files_to_user as coding_send_files
     session_path = Path(session_folder)
     await coding_send_files(message, session_path, files)
 
@@ -152,8 +214,7 @@ async def cmd_ask(message: types.Message, state: FSMContext, command: CommandObj
         # Show category selection
         keyboard = await build_question_categories_keyboard()
         await message.answer(
-            "📝 **Код получен!** Выберите тип вопроса:\n\n"
-            f"```python\n{code[:200]}{'...' if len(code) > 200 else ''}\n```",
+            "📝 **Код получен!** Выберите тип вопроса:\n\n" + _code_preview(code),
             parse_mode="Markdown",
             reply_markup=keyboard
         )
@@ -161,13 +222,7 @@ async def cmd_ask(message: types.Message, state: FSMContext, command: CommandObj
         # Ask for code
         await state.set_state(QuestionStates.waiting_for_question)
         await message.answer(
-            "📝 **Задайте вопрос по коду**\n\n"
-            "Отправьте мне код, а затем выберите тип вопроса.\n"
-            "Вы можете:\n"
-            "1. Отправить код в сообщении с ``` блоками\n"
-            "2. Отправить .py файл\n"
-            "3. Ответить на сообщение с кодом командой /ask\n\n"
-            "Или используйте /cancel чтобы отменить.",
+            ASK_HELP_TEXT,
             parse_mode="Markdown"
         )
 
@@ -179,15 +234,13 @@ async def process_question_code(message: types.Message, state: FSMContext):
     
     # Extract code from message
     code = ""
-    if message.document and message.document.mime_type and 'text' in message.document.mime_type:
-        # Handle file upload
+    if message.document:
+        # Handle file upload, accepting the same files as /debug and /refactor
+        if not is_text_document(message.document):
+            await message.answer(UNSUPPORTED_DOCUMENT_TEXT)
+            return
         try:
-            assert message.bot is not None
-            file = await message.bot.get_file(message.document.file_id)
-            if file.file_path:
-                file_bytes = await message.bot.download_file(file.file_path)
-                assert file_bytes is not None
-                code = file_bytes.read().decode('utf-8')
+            code = await read_text_document(message)
         except Exception as e:
             logger.error(f"Error reading document: {e}")
             await message.answer("❌ Не удалось прочитать файл. Попробуйте ещё раз.")
@@ -205,14 +258,13 @@ async def process_question_code(message: types.Message, state: FSMContext):
     # Show category selection
     keyboard = await build_question_categories_keyboard()
     await message.answer(
-        f"✅ **Код получен!** Выберите тип вопроса:\n\n"
-        f"```python\n{code[:200]}{'...' if len(code) > 200 else ''}\n```",
+        "✅ **Код получен!** Выберите тип вопроса:\n\n" + _code_preview(code),
         parse_mode="Markdown",
         reply_markup=keyboard
     )
 
 
-@router.callback_query(F.data.startswith("question_category:"))
+@router.callback_query(F.data.startswith(CATEGORY_PREFIX))
 async def handle_question_category(callback: CallbackQuery, state: FSMContext):
     """Handle question category selection."""
     if callback.message is None:
@@ -220,7 +272,7 @@ async def handle_question_category(callback: CallbackQuery, state: FSMContext):
         return
     
     msg = cast(types.Message, callback.message)
-    category_id = callback.data.split(":", 1)[1]
+    category_id = callback.data[len(CATEGORY_PREFIX):]
     user_id = callback.from_user.id
     
     if category_id not in QUESTION_CATEGORIES:
@@ -242,9 +294,7 @@ async def handle_question_category(callback: CallbackQuery, state: FSMContext):
     if category_id == "custom_question":
         await state.update_data(question_category=category_id)
         await msg.edit_text(
-            "💭 **Свой вопрос**\n\n"
-            f"```python\n{code[:200]}{'...' if len(code) > 200 else ''}\n```\n\n"
-            "Теперь напишите свой вопрос по этому коду:",
+            CUSTOM_QUESTION_TEXT % _code_preview(code),
             parse_mode="Markdown"
         )
         await state.set_state(QuestionStates.waiting_for_followup)
@@ -252,15 +302,11 @@ async def handle_question_category(callback: CallbackQuery, state: FSMContext):
         return
     
     # For other categories, use template
-    template = category_info["template"]
     if category_id == "code_translate":
         # Need additional info for translation
         await state.update_data(question_category=category_id, question_code=code)
         await msg.edit_text(
-            "🔤 **Перевод кода**\n\n"
-            f"```python\n{code[:200]}{'...' if len(code) > 200 else ''}\n```\n\n"
-            "С какого языка перевести и на какой?\n"
-            "Пример: 'с Python на JavaScript' или 'с JavaScript на Python'",
+            TRANSLATE_QUESTION_TEXT % _code_preview(code),
             parse_mode="Markdown"
         )
         await state.set_state(QuestionStates.waiting_for_followup)
@@ -268,7 +314,8 @@ async def handle_question_category(callback: CallbackQuery, state: FSMContext):
         return
     
     # Prepare question from template
-    question = template.format(code=code)
+    render = _CATEGORY_RENDERERS.get(category_id)
+    question = render(code) if render else category_info["template"].format(code=code)
     await state.update_data(question_text=question, question_category=category_id)
     
     # Send to OpenCode
@@ -297,19 +344,26 @@ async def process_custom_question(message: types.Message, state: FSMContext):
     if category_id == "code_translate":
         language_info = message.text.strip()
         template = QUESTION_CATEGORIES[category_id]["template"]
-        question = template.format(from_lang="Python", to_lang="JavaScript", code=code)
-        # Try to parse language info
-        if "на" in language_info and "с" in language_info:
-            # Extract languages from text like "с Python на JavaScript"
-            parts = language_info.split()
-            try:
-                from_idx = parts.index("с")
-                to_idx = parts.index("на")
-                from_lang = parts[from_idx + 1] if from_idx + 1 < len(parts) else "Python"
-                to_lang = parts[to_idx + 1] if to_idx + 1 < len(parts) else "JavaScript"
-                question = template.format(from_lang=from_lang, to_lang=to_lang, code=code)
-            except (ValueError, IndexError):
-                pass
+        # Extract languages from text like "с Python на JavaScript" in one pass over the words
+        parts = language_info.split()
+        from_idx = to_idx = -1
+        for k, token in enumerate(parts):
+            token = token.casefold()
+            if token == "с" and from_idx < 0:
+                from_idx = k
+            elif token == "на" and to_idx < 0:
+                to_idx = k
+            if from_idx >= 0 and to_idx >= 0:
+                break
+        
+        from_lang = "Python"
+        to_lang = "JavaScript"
+        if from_idx >= 0 and to_idx >= 0:
+            if from_idx + 1 < len(parts):
+                from_lang = parts[from_idx + 1]
+            if to_idx + 1 < len(parts):
+                to_lang = parts[to_idx + 1]
+        question = template.format(from_lang=from_lang, to_lang=to_lang, code=code)
     else:
         # Custom question
         question = f"{message.text}\n\nКод:\n```python\n{code}\n```"
@@ -326,7 +380,12 @@ async def process_question_with_opencode(
     user_id: int
 ):
     """Send question to OpenCode and process response."""
-    active_session = await session_manager.get_active_session(user_id)
+    # The three lookups are independent; the provider default may need a request to OpenCode
+    active_session, user_prefs, thinking_enabled = await asyncio.gather(
+        session_manager.get_active_session(user_id),
+        session_manager.get_user_preference(user_id),
+        session_manager.get_thinking_preference(user_id)
+    )
     if active_session is None:
         await message.answer("❌ Сессия не найдена.")
         await state.clear()
@@ -339,88 +398,91 @@ async def process_question_with_opencode(
         return
     
     session_id = active_session['id']
-    user_prefs = await session_manager.get_user_preference(user_id)
     provider_id = user_prefs.get("provider_id", "")
     model_id = user_prefs.get("model_id", "")
     
     # Get session folder for file tracking
     session_folder_path = session_files.get_session_folder(session_id)
     file_tracker = None
+    snapshot_task = None
     try:
         file_tracker = FileChangeTracker(Path(session_folder_path))
-        await file_tracker.take_before_snapshot()
-        logger.debug(f"File tracking started for question session: {session_id}")
+        # The folder scan runs while the status message is sent; it is awaited before OpenCode starts
+        snapshot_task = asyncio.create_task(file_tracker.take_before_snapshot())
     except Exception as e:
         logger.warning(f"Failed to initialize file tracker: {e}")
     
     # Send status message
-    status_message = await message.answer(
-        f"🧠 **Анализирую вопрос...**\n\n"
-        f"Используя: {provider_id}/{model_id}\n"
-        "Пожалуйста, подождите...",
-        parse_mode="Markdown"
-    )
-    
-    # Collect thinking blocks
-    thinking_messages = []
-    last_thinking_sent = 0.0
+    try:
+        status_message = await message.answer(
+            f"🧠 **Анализирую вопрос...**\n\n"
+            f"Используя: {provider_id}/{model_id}\n"
+            "Пожалуйста, подождите...",
+            parse_mode="Markdown"
+        )
+    except BaseException:
+        # The snapshot will never be awaited now; cancel it and retrieve any error it already raised
+        if snapshot_task is not None:
+            snapshot_task.cancel()
+            snapshot_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        raise
+    
+    # Collect thinking blocks; the display preference was read once above
+    thinking_count = 0  # only the number of sent thinking messages is needed
+    loop = asyncio.get_running_loop()
+    last_thinking_sent = float("-inf")
     MIN_THINKING_INTERVAL = 0.3
     
     async def thinking_callback(thinking_text: str):
         """Callback for thinking blocks."""
-        nonlocal last_thinking_sent
+        nonlocal last_thinking_sent, thinking_count
         
-        if not thinking_text or len(thinking_text.strip()) == 0:
+        # Check if thinking display is enabled
+        if not thinking_enabled:
             return
         
-        # Check if thinking display is enabled
-        if not await session_manager.get_thinking_preference(user_id):
+        if not thinking_text or len(thinking_text.strip()) == 0:
             return
         
         # Log thinking
         logger.info(f"Thinking: {thinking_text[:200]}...")
         
+        # Rate limiting, before any work is spent on a block that will be dropped
+        current_time = loop.time()
+        if current_time - last_thinking_sent < MIN_THINKING_INTERVAL:
+            return
+        
         # Split long thinking
         thinking_display = thinking_text.strip()
         max_length = 3500
+        parts = split_text_into_parts(thinking_display, max_length)
         
-        if len(thinking_display) <= max_length:
-            parts = [thinking_display]
+        n = len(parts)
+        if n == 1:
+            texts = [f"🤔 *Thinking*: {parts[0]}"]
         else:
-            # Simple split function
-            parts = []
-            while len(thinking_display) > max_length:
-                split_at = max_length
-                for separator in ['. ', '! ', '? ', '\n\n', '\n', ' ']:
-                    pos = thinking_display.rfind(separator, 0, max_length)
-                    if pos > 0 and pos > max_length * 0.7:
-                        split_at = pos + len(separator)
-                        break
-                
-                part = thinking_display[:split_at].strip()
-                if part:
-                    parts.append(part)
-                thinking_display = thinking_display[split_at:].strip()
-            
-            if thinking_display:
-                parts.append(thinking_display)
+            texts = [f"🤔 *Thinking ({i+1}/{n})*: {part}" for i, part in enumerate(parts)]
         
-        for i, part in enumerate(parts):
-            # Rate limiting
-            current_time = time.time()
-            if current_time - last_thinking_sent < MIN_THINKING_INTERVAL:
-                continue
-            
-            prefix = "🤔 *Thinking*"
-            if len(parts) > 1:
-                prefix = f"🤔 *Thinking ({i+1}/{len(parts)})*"
-            
-            try:
-                thinking_msg = await message.answer(f"{prefix}: {part}", parse_mode="Markdown")
-                thinking_messages.append(thinking_msg.message_id)
+        # Queue all parts at once; the per-chat limiter in send() admits them in order
+        chat_id = message.chat.id
+        sent = await asyncio.gather(
+            *(send(lambda text=text: message.answer(text, parse_mode="Markdown"), chat_id) for text in texts),
+            return_exceptions=True
+        )
+        for i, thinking_msg in enumerate(sent):
+            if isinstance(thinking_msg, Exception):
+                logger.warning(f"Failed to send thinking message part {i+1}: {thinking_msg}")
+            else:
+                thinking_count += 1
                 last_thinking_sent = current_time
-            except Exception as e:
-                logger.warning(f"Failed to send thinking message part {i+1}: {e}")
+    
+    if snapshot_task is not None:
+        try:
+            await snapshot_task
+            logger.debug(f"File tracking started for question session: {session_id}")
+        except Exception as e:
+            logger.warning(f"Failed to initialize file tracker: {e}")
+            file_tracker = None
     
     try:
         # Call OpenCode
@@ -455,25 +517,17 @@ async def process_question_with_opencode(
             logger.error(f"Failed to get file changes: {e}")
     
     # Process result
-    if isinstance(result, dict):
-        response_text = result.get("response", "")
-        files = result.get("files", {})
-        session_folder = result.get("session_folder", "")
-        error_flag = result.get("error", False)
-        
-        if error_flag:
-            await status_message.edit_text(
-                f"❌ **Ошибка OpenCode**\n\n```\n{response_text[:500]}\n```",
-                parse_mode="Markdown"
-            )
-            await state.clear()
-            return
-    else:
-        # Backward compatibility
-        response_text = str(result) if result else "Нет ответа"
-        files = {"created": [], "modified": [], "all": []}
-        session_folder = ""
-        logger.warning("Received string result instead of dict")
+    response_text = result.response
+    files = result.files
+    session_folder = result.session_folder
+    
+    if result.error:
+        await status_message.edit_text(
+            f"❌ **Ошибка OpenCode**\n\n```\n{response_text[:500]}\n```",
+            parse_mode="Markdown"
+        )
+        await state.clear()
+        return
     
     # Update status message
     try:
@@ -507,8 +561,8 @@ async def process_question_with_opencode(
             await message.answer(f"⚠️ Файлы созданы, но не удалось отправить: {str(e)[:200]}")
     
     # Log thinking messages
-    if thinking_messages:
-        logger.info(f"Sent {len(thinking_messages)} thinking messages")
+    if thinking_count:
+        logger.info(f"Sent {thinking_count} thinking messages")
     
     await state.clear()
 
@@ -560,29 +614,30 @@ async def handle_followup_action(callback: CallbackQuery, state: FSMContext):
         file_paths = [file_info['name'] for file_info in files_list]
         session_path = Path(session_folder)
         
-        # Create archive
-        archive_buffer, archive_name, files_added = await ArchiveCreator.create_session_archive(
-            session_path, file_paths
+        # Archive goes to a temporary file so it is streamed from disk rather than copied in memory
+        archive_path, archive_name, files_added = await ArchiveCreator.create_session_archive(
+            session_path, file_paths, to_file=True
         )
         
-        if not archive_buffer or files_added == 0:
+        if not archive_path or files_added == 0:
             await callback.answer("❌ Не удалось создать архив")
             return
         
         # Send archive
-        archive_size = ArchiveCreator.get_archive_size(archive_buffer)
-        size_str = ArchiveCreator._format_size(archive_size)
-        
         try:
-            from aiogram.types import BufferedInputFile
+            archive_size = os.path.getsize(archive_path)
+            size_str = ArchiveCreator._format_size(archive_size)
+            
             await callback.message.answer_document(
-                BufferedInputFile(archive_buffer.getvalue(), filename=archive_name),
+                FSInputFile(archive_path, filename=archive_name),
                 caption=f"📦 Архив сессии: {archive_name}\n📁 Файлов: {files_added}\n📊 Размер: {size_str}"
             )
             await callback.answer("✅ Архив отправлен")
         except Exception as e:
             logger.error(f"Failed to send archive: {e}")
             await callback.answer("❌ Ошибка отправки архива")
+        finally:
+            os.unlink(archive_path)
     
     else:
         # Other follow-up actions require starting a new question
@@ -618,13 +673,7 @@ async def handle_question_start(callback: CallbackQuery, state: FSMContext):
         return
     
     await callback.message.edit_text(
-        "📝 **Задайте вопрос по коду**\n\n"
-        "Отправьте мне код, а затем выберите тип вопроса.\n"
-        "Вы можете:\n"
-        "1. Отправить код в сообщении с ``` блоками\n"
-        "2. Отправить .py файл\n"
-        "3. Ответить на сообщение с кодом командой /ask\n\n"
-        "Или используйте /cancel чтобы отменить.",
+        ASK_HELP_TEXT,
         parse_mode="Markdown"
     )
     
@@ -6,9 +6,10 @@ from core.session_manager import session_manager
 from core import session_files
 from core.archive_utils import ArchiveCreator
 from core.config import settings
-from aiogram.types import FSInputFile, BufferedInputFile
+from utils.ratelimit import send
+from aiogram.types import FSInputFile
 import logging
-import asyncio
+import os
 from pathlib import Path
 
 router = Router()
@@ -27,13 +28,14 @@ async def _send_individual_files(message: types.Message, session_folder: Path, f
     for abs_path, rel_path in files_to_send:
         try:
             # Send as document with caption showing relative path
-            await message.answer_document(
-                FSInputFile(str(abs_path), filename=abs_path.name),
-                caption=f"`{rel_path}`"
+            await send(
+                lambda: message.answer_document(
+                    FSInputFile(str(abs_path), filename=abs_path.name),
+                    caption=f"`{rel_path}`"
+                ),
+                message.chat.id
             )
             logger.debug(f"Sent file: {rel_path}")
-            # Small delay to avoid rate limiting
-            await asyncio.sleep(0.5)
         except Exception as e:
             logger.error(f"Failed to send file {rel_path}: {e}")
 
@@ -41,24 +43,30 @@ async def _send_archive(message: types.Message, session_folder: Path, file_paths
     """Create and send ZIP archive of files."""
     logger.info(f"Creating archive for {len(file_paths)} files")
     
-    archive_buffer, archive_name, files_added = await ArchiveCreator.create_session_archive(
-        session_folder, file_paths
+    # Archive goes to a temporary file so no in-memory buffer is allocated per request
+    archive_path, archive_name, files_added = await ArchiveCreator.create_session_archive(
+        session_folder, file_paths, to_file=True
     )
     
-    if not archive_buffer or files_added == 0:
+    if not archive_path or files_added == 0:
         await message.answer("❌ Failed to create file archive.")
         return
     
     # Send archive
     try:
-        await message.answer_document(
-            BufferedInputFile(archive_buffer.getvalue(), filename=archive_name),
-            caption=f"📦 Archive: {archive_name} ({files_added} files)"
+        await send(
+            lambda: message.answer_document(
+                FSInputFile(archive_path, filename=archive_name),
+                caption=f"📦 Archive: {archive_name} ({files_added} files)"
+            ),
+            message.chat.id
         )
         logger.info(f"Sent archive {archive_name} with {files_added} files")
     except Exception as e:
         logger.error(f"Failed to send archive: {e}")
         await message.answer("❌ Failed to send archive file.")
+    finally:
+        os.unlink(archive_path)
 
 async def send_session_files(message: types.Message, session_folder: Path, all_files: list) -> None:
     """Send session files to user via Telegram."""
@@ -7,6 +7,7 @@ import atexit
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
 from core.config import settings
 from utils.logger import setup_logger
 from bot.handlers import base, session, coding, providers, unknown, questions
@@ -14,11 +15,26 @@ from core.opencode_proxy import opencode_client
 
 logger = setup_logger()
 
+try:
+    import msgspec  # optional: faster JSON codec for Bot API requests and updates
+except ImportError:
+    msgspec = None
+
+def create_bot_session() -> AiohttpSession:
+    """Bot API session, using msgspec's JSON encoder and decoder when installed."""
+    if msgspec is None:
+        return AiohttpSession()
+    encoder = msgspec.json.Encoder()
+    return AiohttpSession(
+        json_loads=msgspec.json.decode,
+        json_dumps=lambda obj: encoder.encode(obj).decode()
+    )
+
 async def main():
     logger.info("Starting OpenCode Telegram Bot...")
     logger.info("Hello Klavdii is work!")
     
-    bot = Bot(token=settings.bot_token.get_secret_value())
+    bot = Bot(token=settings.bot_token.get_secret_value(), session=create_bot_session())
     dp = Dispatcher()
     
     # Include routers
@@ -31,7 +47,9 @@ async def main():
     
     try:
         await bot.delete_webhook(drop_pending_updates=True)
-        await dp.start_polling(bot)
+        # Only ask Telegram for update types that some router handles,
+        # so unused updates are never fetched and decoded
+        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     except Exception as e:
         logger.error(f"Error occurred: {e}")
     finally:
@@ -2,17 +2,75 @@
 Archive creation utilities for OpenKlavdii bot.
 Creates ZIP archives for sending multiple files via Telegram.
 """
+import os
+import tempfile
 import zipfile
 import asyncio
 from io import BytesIO
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 import logging
 from datetime import datetime
 
 logger = logging.getLogger("opencode_bot")
 
 
+def _write_archive(
+    session_folder: Path,
+    file_paths: List[str],
+    target: Union[str, BytesIO]
+) -> Tuple[int, int]:
+    """
+    Write session files into a ZIP archive (runs in a worker thread).
+    
+    Args:
+        session_folder: Root folder containing files
+        file_paths: List of relative file paths to include
+        target: Path of the archive file or an in-memory buffer
+        
+    Returns:
+        Tuple of (file_count, archive_size)
+    """
+    files_added = 0
+    total_size = 0
+    
+    with zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for rel_path in file_paths:
+            abs_path = session_folder / rel_path
+            
+            # Check if file exists
+            if not abs_path.exists():
+                logger.warning(f"File not found, skipping: {rel_path}")
+                continue
+            
+            # Check file size
+            file_size = abs_path.stat().st_size
+            if file_size > ArchiveCreator.MAX_ARCHIVE_SIZE:
+                logger.warning(f"File too large ({file_size} bytes), skipping: {rel_path}")
+                continue
+            
+            # Estimate archive size (approximate compression ratio 2:1)
+            estimated_archive_size = total_size + (file_size // 2)
+            if estimated_archive_size > ArchiveCreator.MAX_ARCHIVE_SIZE:
+                logger.warning("Archive would exceed size limit, skipping remaining files")
+                break
+            
+            # Add file to archive
+            try:
+                zipf.write(abs_path, rel_path)
+                files_added += 1
+                total_size += file_size
+                logger.debug(f"Added file to archive: {rel_path} ({file_size} bytes)")
+            except Exception as e:
+                logger.error(f"Failed to add file {rel_path} to archive: {e}")
+    
+    if isinstance(target, BytesIO):
+        archive_size = target.getbuffer().nbytes
+    else:
+        archive_size = os.path.getsize(target)
+    return files_added, archive_size
+
+
 class ArchiveCreator:
     """Create ZIP archives for session files."""
     
@@ -23,18 +81,21 @@ class ArchiveCreator:
     async def create_session_archive(
         session_folder: Path, 
         file_paths: List[str],
-        archive_name: Optional[str] = None
-    ) -> Tuple[Optional[BytesIO], str, int]:
+        archive_name: Optional[str] = None,
+        to_file: bool = False
+    ) -> Tuple[Optional[Union[BytesIO, Path]], str, int]:
         """
-        Create ZIP archive of session files in memory.
+        Create ZIP archive of session files in memory or in a temporary file.
         
         Args:
             session_folder: Root folder containing files
             file_paths: List of relative file paths to include
             archive_name: Custom archive name (optional)
+            to_file: Write the archive to a temporary file and return its path
+                instead of a buffer; the caller is responsible for deleting it
             
         Returns:
-            Tuple of (archive_buffer, archive_name, file_count) or (None, "", 0) on error
+            Tuple of (archive_buffer or archive_path, archive_name, file_count) or (None, "", 0) on error
         """
         if not file_paths:
             logger.warning("No files to archive")
@@ -45,58 +106,46 @@ class ArchiveCreator:
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             archive_name = f"session_{session_folder.name}_{timestamp}.zip"
         
-        zip_buffer = BytesIO()
-        files_added = 0
-        total_size = 0
+        if to_file:
+            with tempfile.NamedTemporaryFile(suffix=".zip", delete=False) as tmp:
+                zip_buffer = tmp
+            target = tmp.name
+        else:
+            zip_buffer = BytesIO()
+            target = zip_buffer
         
         try:
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                for rel_path in file_paths:
-                    abs_path = session_folder / rel_path
-                    
-                    # Check if file exists
-                    if not abs_path.exists():
-                        logger.warning(f"File not found, skipping: {rel_path}")
-                        continue
-                    
-                    # Check file size
-                    file_size = abs_path.stat().st_size
-                    if file_size > ArchiveCreator.MAX_ARCHIVE_SIZE:
-                        logger.warning(f"File too large ({file_size} bytes), skipping: {rel_path}")
-                        continue
-                    
-                    # Estimate archive size (approximate compression ratio 2:1)
-                    estimated_archive_size = total_size + (file_size // 2)
-                    if estimated_archive_size > ArchiveCreator.MAX_ARCHIVE_SIZE:
-                        logger.warning(f"Archive would exceed size limit, skipping remaining files")
-                        break
-                    
-                    # Add file to archive
-                    try:
-                        zipf.write(abs_path, rel_path)
-                        files_added += 1
-                        total_size += file_size
-                        logger.debug(f"Added file to archive: {rel_path} ({file_size} bytes)")
-                    except Exception as e:
-                        logger.error(f"Failed to add file {rel_path} to archive: {e}")
-                        continue
+            # Compress in a worker thread; zlib releases the GIL while deflating
+            files_added, archive_size = await asyncio.to_thread(
+                _write_archive, session_folder, file_paths, target
+            )
             
             if files_added == 0:
                 logger.warning("No files were added to archive")
+                ArchiveCreator._discard(zip_buffer)
                 return None, "", 0
             
-            # Get final archive size
-            zip_buffer.seek(0, 2)  # Seek to end
-            archive_size = zip_buffer.tell()
-            zip_buffer.seek(0)  # Seek back to start
-            
             logger.info(f"Created archive '{archive_name}' with {files_added} files, size: {archive_size} bytes")
+            if to_file:
+                return Path(target), archive_name, files_added
+            zip_buffer.seek(0)
             return zip_buffer, archive_name, files_added
             
         except Exception as e:
             logger.error(f"Failed to create archive: {e}")
+            ArchiveCreator._discard(zip_buffer)
             return None, "", 0
     
+    @staticmethod
+    def _discard(zip_buffer) -> None:
+        """Close an unused archive target, removing it from disk if it is a temporary file."""
+        zip_buffer.close()
+        if not isinstance(zip_buffer, BytesIO):
+            try:
+                os.unlink(zip_buffer.name)
+            except OSError:
+                pass
+    
     @staticmethod
     def get_archive_size(zip_buffer: BytesIO) -> int:
         """Get archive size in bytes without consuming buffer."""
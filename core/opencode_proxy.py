@@ -1,26 +1,81 @@
 import asyncio
+import functools
 import aiohttp
-from typing import Dict, Any, List, Optional
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 import logging
 import subprocess
 import json
 import re
 import os
+import time
 from pathlib import Path
 from core import session_files
 from core.file_tracker import FileChangeTracker
 
 logger = logging.getLogger("opencode_bot")
 
+PROVIDERS_CACHE_TTL = 30.0  # seconds
+
+
+@dataclass(frozen=True)
+class OpenCodeResult:
+    """Normalized result of generate_code/debug_code/refactor_code."""
+    __slots__ = ("response", "files", "session_folder", "error")
+    response: str
+    files: Dict[str, List[str]]
+    session_folder: str
+    error: bool
+
+    @classmethod
+    def from_raw(cls, result: Any) -> "OpenCodeResult":
+        """Build a result from the legacy dict (or, for old callers, a plain string)."""
+        if isinstance(result, dict):
+            return cls(
+                response=result.get("response", ""),
+                files=result.get("files", {}),
+                session_folder=result.get("session_folder", ""),
+                error=result.get("error", False)
+            )
+        logger.warning("Received string result instead of dict, using backward compatibility")
+        return cls(
+            response=str(result) if result else "No response received",
+            files={"created": [], "modified": [], "all": []},
+            session_folder="",
+            error=False
+        )
+
+
+def _returns_result(method: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[OpenCodeResult]]:
+    """Convert the dict a code task method builds into an OpenCodeResult at the client boundary.
+
+    The wrapped methods are annotated with the dict they build; callers receive the OpenCodeResult.
+    """
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs) -> OpenCodeResult:
+        return OpenCodeResult.from_raw(await method(*args, **kwargs))
+    return wrapper
+
 class OpenCodeProxy:
     def __init__(self, api_url: str):
         self.api_url = api_url.rstrip('/')
         self.session: aiohttp.ClientSession | None = None
+        # (fetched_at, providers) of the last successful /provider response
+        self._providers_cache: Optional[Tuple[float, Dict[str, Any]]] = None
+        # Fetch of /provider in progress, shared by every caller that misses the cache meanwhile
+        self._providers_fetch: Optional["asyncio.Task[Dict[str, Any]]"] = None
     
     async def ensure_session(self):
         if self.session is None or self.session.closed:
+            # One pooled session for the bot's lifetime; closed in close() on shutdown
             self.session = aiohttp.ClientSession(
-                connector=aiohttp.TCPConnector(ssl=False),
+                connector=aiohttp.TCPConnector(
+                    ssl=False,
+                    limit=100,
+                    limit_per_host=20,
+                    ttl_dns_cache=300,
+                    keepalive_timeout=60
+                ),
                 timeout=aiohttp.ClientTimeout(total=60)
             )
         assert self.session is not None
@@ -48,6 +103,27 @@ class OpenCodeProxy:
             return ""
     
     async def get_providers(self) -> Dict[str, Any]:
+        """Return providers from OpenCode, reusing a response younger than PROVIDERS_CACHE_TTL."""
+        cached = self._providers_cache
+        if cached is not None and time.monotonic() - cached[0] < PROVIDERS_CACHE_TTL:
+            return cached[1]
+        
+        fetch = self._providers_fetch
+        if fetch is None:
+            fetch = self._providers_fetch = asyncio.ensure_future(self._refresh_providers())
+        # A cancelled caller must not cancel the fetch the other callers are waiting on
+        return await asyncio.shield(fetch)
+    
+    async def _refresh_providers(self) -> Dict[str, Any]:
+        try:
+            result = await self._fetch_providers()
+            if result.get("all") or result.get("connected"):
+                self._providers_cache = (time.monotonic(), result)
+            return result
+        finally:
+            self._providers_fetch = None
+    
+    async def _fetch_providers(self) -> Dict[str, Any]:
         await self.ensure_session()
         assert self.session is not None
         url = f"{self.api_url}/provider"
@@ -363,6 +439,7 @@ class OpenCodeProxy:
         # Use CLI implementation
         return await self._send_message_via_cli(prompt, provider_id, model_id, session_id, thinking_callback, telegram_session_id)
     
+    @_returns_result
     async def generate_code(self, prompt: str, language: str, session_id: str, provider_id: str = "", model_id: str = "", thinking_callback=None) -> Dict[str, Any]:
         logger.info(f"generate_code called: prompt={prompt[:50]}..., language={language}, session_id={session_id}, provider={provider_id}, model={model_id}")
         
@@ -456,6 +533,7 @@ class OpenCodeProxy:
                 "error": True
             }
     
+    @_returns_result
     async def debug_code(self, code: str, error: str, session_id: str, provider_id: str = "", model_id: str = "", thinking_callback=None) -> Dict[str, Any]:
         logger.info(f"debug_code called: error={error[:50]}..., session_id={session_id}, provider={provider_id}, model={model_id}")
         
@@ -545,6 +623,7 @@ class OpenCodeProxy:
                 "error": True
             }
     
+    @_returns_result
     async def refactor_code(self, code: str, focus: str, session_id: str, provider_id: str = "", model_id: str = "", thinking_callback=None) -> Dict[str, Any]:
         logger.info(f"refactor_code called: focus={focus[:50]}..., session_id={session_id}, provider={provider_id}, model={model_id}")
         
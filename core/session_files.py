@@ -85,14 +85,17 @@ def list_session_files(session_id: str) -> list:
     if not folder.exists():
         return []
     
+    # scandir knows the entry type from the directory listing, so each file is stat'ed once
     files = []
-    for item in folder.iterdir():
-        if item.is_file():
-            files.append({
-                "name": item.name,
-                "size": item.stat().st_size,
-                "modified": item.stat().st_mtime
-            })
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                files.append({
+                    "name": entry.name,
+                    "size": stat.st_size,
+                    "modified": stat.st_mtime
+                })
     
     return sorted(files, key=lambda x: x["modified"])
 
@@ -196,30 +199,25 @@ def publish_to_github(session_id: str, repo_path: str = "../klavdii_work_place")
     
     logger.info(f"Copied {len(copied_files)} files: {copied_files}")
     
-    # Git operations
-    original_cwd = None
+    # Git operations run with cwd=repo rather than os.chdir, which would move the
+    # whole process (this runs in a worker thread while the bot keeps serving)
     try:
-        # Change to repo directory
-        original_cwd = Path.cwd()
-        os.chdir(repo)
-        logger.info(f"Changed directory to: {repo}")
-        
         # Setup SSH environment for git operations
         ssh_env = setup_ssh_environment()
         
         # Configure git user if not configured
         try:
             subprocess.run(["git", "config", "user.email", "klavdii-bot@example.com"], 
-                         capture_output=True, text=True, check=False, env=ssh_env)
+                         capture_output=True, text=True, check=False, cwd=repo, env=ssh_env)
             subprocess.run(["git", "config", "user.name", "Klavdii Bot"], 
-                         capture_output=True, text=True, check=False, env=ssh_env)
+                         capture_output=True, text=True, check=False, cwd=repo, env=ssh_env)
         except Exception as e:
             logger.warning(f"Could not configure git user: {e}")
         
         # Check if repository has any commits
         try:
             result = subprocess.run(["git", "rev-parse", "--verify", "HEAD"], 
-                                   capture_output=True, text=True, env=ssh_env)
+                                   capture_output=True, text=True, cwd=repo, env=ssh_env)
             has_commits = result.returncode == 0
         except Exception:
             has_commits = False
@@ -231,22 +229,22 @@ def publish_to_github(session_id: str, repo_path: str = "../klavdii_work_place")
             if not readme_path.exists():
                 with open(readme_path, "w") as f:
                     f.write("# Klavdii Work Place\n\nGitHub repository for Klavdii bot session files.\n")
-                subprocess.run(["git", "add", "README.md"], capture_output=True, text=True, check=False, env=ssh_env)
+                subprocess.run(["git", "add", "README.md"], capture_output=True, text=True, check=False, cwd=repo, env=ssh_env)
             
             # Create initial commit
             subprocess.run(["git", "commit", "-m", "Initial commit - Klavdii Work Place"], 
-                         capture_output=True, text=True, check=False, env=ssh_env)
+                         capture_output=True, text=True, check=False, cwd=repo, env=ssh_env)
             
             # Determine default branch name (main or master)
             try:
                 result = subprocess.run(["git", "branch", "--show-current"], 
-                                       capture_output=True, text=True, check=True, env=ssh_env)
+                                       capture_output=True, text=True, check=True, cwd=repo, env=ssh_env)
                 branch_name = result.stdout.strip()
             except Exception:
                 # Try to check remote
                 try:
                     result = subprocess.run(["git", "remote", "show", "origin"], 
-                                           capture_output=True, text=True, check=False, env=ssh_env)
+                                           capture_output=True, text=True, check=False, cwd=repo, env=ssh_env)
                     if "HEAD branch: main" in result.stdout:
                         branch_name = "main"
                     else:
@@ -258,21 +256,21 @@ def publish_to_github(session_id: str, repo_path: str = "../klavdii_work_place")
             if not branch_name:
                 branch_name = "main"
                 subprocess.run(["git", "branch", "-M", branch_name], 
-                             capture_output=True, text=True, check=False, env=ssh_env)
+                             capture_output=True, text=True, check=False, cwd=repo, env=ssh_env)
         
         # Add session files
         subprocess.run(["git", "add", str(target_dir.relative_to(repo))], 
-                     capture_output=True, text=True, check=False, env=ssh_env)
+                     capture_output=True, text=True, check=False, cwd=repo, env=ssh_env)
         
         # Commit
         commit_message = f"Add session {session_id} - {datetime.now().isoformat()}"
         commit_result = subprocess.run(["git", "commit", "-m", commit_message], 
-                                     capture_output=True, text=True, check=False, env=ssh_env)
+                                     capture_output=True, text=True, check=False, cwd=repo, env=ssh_env)
         
         if commit_result.returncode != 0:
             # Check if there are changes to commit
             status_result = subprocess.run(["git", "status", "--porcelain"], 
-                                         capture_output=True, text=True, check=True, env=ssh_env)
+                                         capture_output=True, text=True, check=True, cwd=repo, env=ssh_env)
             if not status_result.stdout.strip():
                 logger.warning("No changes to commit")
             else:
@@ -282,30 +280,30 @@ def publish_to_github(session_id: str, repo_path: str = "../klavdii_work_place")
         try:
             # Determine current branch
             branch_result = subprocess.run(["git", "branch", "--show-current"], 
-                                         capture_output=True, text=True, check=True, env=ssh_env)
+                                         capture_output=True, text=True, check=True, cwd=repo, env=ssh_env)
             current_branch = branch_result.stdout.strip() or "main"
 
             # Pull latest changes to avoid non-fast-forward errors
             logger.info("Pulling latest changes from remote...")
             pull_result = subprocess.run(["git", "pull", "--rebase", "origin", current_branch], 
-                                       capture_output=True, text=True, check=False, env=ssh_env)
+                                       capture_output=True, text=True, check=False, cwd=repo, env=ssh_env)
             if pull_result.returncode != 0:
                 logger.warning(f"Git pull failed: {pull_result.stderr}")
                 # Try without rebase as fallback
                 pull_result = subprocess.run(["git", "pull", "origin", current_branch], 
-                                           capture_output=True, text=True, check=False, env=ssh_env)
+                                           capture_output=True, text=True, check=False, cwd=repo, env=ssh_env)
                 if pull_result.returncode != 0:
                     logger.warning(f"Git pull (non-rebase) also failed: {pull_result.stderr}")
 
             # Push with set-upstream if needed
             push_result = subprocess.run(["git", "push", "-u", "origin", current_branch], 
-                                       capture_output=True, text=True, check=False, env=ssh_env)
+                                       capture_output=True, text=True, check=False, cwd=repo, env=ssh_env)
             
             if push_result.returncode != 0:
                 logger.warning(f"Git push with -u failed, trying simple push...")
                 # Try simple push as fallback
                 push_result = subprocess.run(["git", "push"], 
-                                           capture_output=True, text=True, check=False, env=ssh_env)
+                                           capture_output=True, text=True, check=False, cwd=repo, env=ssh_env)
             
             if push_result.returncode != 0:
                 logger.error(f"Git push failed: {push_result.stderr}")
@@ -332,17 +330,10 @@ def publish_to_github(session_id: str, repo_path: str = "../klavdii_work_place")
             return {"success": False, "error": f"Push error: {str(push_error)}", "files_copied": copied_files}
         
         logger.info(f"Git push successful for session {session_id}")
-        os.chdir(original_cwd)
         
         logger.info(f"Published session {session_id} to GitHub")
         return {"success": True, "files_copied": copied_files, "repo": repo_path}
     
     except Exception as e:
         logger.error(f"Error during git operations: {e}")
-        # Try to restore original directory
-        if original_cwd is not None:
-            try:
-                os.chdir(str(original_cwd))
-            except:
-                pass
         return {"success": False, "error": str(e), "files_copied": copied_files}
\ No newline at end of file
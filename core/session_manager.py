@@ -56,6 +56,10 @@ class SessionManager:
             return []
         return list(self.sessions[user_id].values())
 
+    def get_active_session_id(self, user_id: int) -> Optional[str]:
+        """Active session id without loading the session, for menus that only show it"""
+        return self.active_sessions.get(user_id)
+
     async def switch_session(self, user_id: int, session_id: str) -> bool:
         if user_id in self.sessions and session_id in self.sessions[user_id]:
             self.active_sessions[user_id] = session_id
@@ -69,6 +73,10 @@ class SessionManager:
         self.user_preferences[user_id]["provider_id"] = provider_id
         self.user_preferences[user_id]["model_id"] = model_id
 
+    def get_stored_preference(self, user_id: int) -> Dict[str, Any]:
+        """Preferences the user has set, without falling back to the server default"""
+        return self.user_preferences.get(user_id, {})
+
     async def get_user_preference(self, user_id: int) -> Dict[str, str]:
         if user_id not in self.user_preferences:
             default = await opencode_client.get_default_provider()
@@ -88,14 +96,10 @@ class SessionManager:
         self.user_preferences[user_id]["show_thinking"] = enabled
     
     async def get_thinking_preference(self, user_id: int) -> bool:
-        import logging
-        logger = logging.getLogger("opencode_bot")
-        if user_id not in self.user_preferences:
-            logger.debug(f"get_thinking_preference: user {user_id} not in preferences, default True")
+        prefs = self.user_preferences.get(user_id)
+        if prefs is None:
             return True  # default enabled
-        result = self.user_preferences[user_id].get("show_thinking", True)
-        logger.debug(f"get_thinking_preference: user {user_id} = {result}")
-        return result
+        return prefs.get("show_thinking", True)
     
     async def get_session_folder(self, user_id: int) -> Optional[Path]:
         """Get the folder path for the active session"""
@@ -7,7 +7,7 @@ import unittest
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from core.session_manager import SessionManager
-from core.opencode_proxy import OpenCodeProxy
+from core.opencode_proxy import OpenCodeProxy, OpenCodeResult
 
 class TestCoreComponents(unittest.TestCase):
     def setUp(self):
@@ -32,8 +32,9 @@ class TestCoreComponents(unittest.TestCase):
     def test_proxy_generation(self):
         async def run():
             result = await self.proxy.generate_code("print hello", "python", "sess-1")
-            self.assertIn("def solve_problem():", result)
-            self.assertIn("sess-1", result)
+            self.assertIsInstance(result, OpenCodeResult)
+            self.assertIn("def solve_problem():", result.response)
+            self.assertIn("sess-1", result.session_folder)
         
         asyncio.run(run())
 
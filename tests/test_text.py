@@ -0,0 +1,119 @@
+import random
+import sys
+import os
+import unittest
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from utils.text import extract_fenced_code, split_code_into_parts, split_text_into_parts
+
+def reference_split(text, max_length=3500):
+    """The original slicing splitter, kept as the expected behaviour."""
+    parts = []
+    while len(text) > max_length:
+        split_at = max_length
+        for separator in ['. ', '! ', '? ', '\n\n', '\n', ' ']:
+            pos = text.rfind(separator, 0, max_length)
+            if pos > 0 and pos > max_length * 0.7:
+                split_at = pos + len(separator)
+                break
+
+        part = text[:split_at].strip()
+        if part:
+            parts.append(part)
+        text = text[split_at:].strip()
+
+    if text:
+        parts.append(text)
+    return parts
+
+class TestSplitTextIntoParts(unittest.TestCase):
+    def assertSplitsLikeReference(self, text, max_length):
+        self.assertEqual(split_text_into_parts(text, max_length), reference_split(text, max_length))
+
+    def test_prefers_sentence_end_over_later_space(self):
+        text = "a" * 80 + ". " + "b " * 15
+        self.assertSplitsLikeReference(text, 100)
+        self.assertEqual(split_text_into_parts(text, 100)[0], "a" * 80 + ".")
+
+    def test_code_lines(self):
+        text = "".join(f"x{i} = compute(alpha, beta, gamma, delta)\n" for i in range(200))
+        self.assertSplitsLikeReference(text, 3500)
+
+    def test_short_and_empty_text(self):
+        self.assertEqual(split_text_into_parts("", 100), [])
+        self.assertEqual(split_text_into_parts("  short  ", 100), ["  short  "])
+
+    def test_hard_cut_and_surrounding_whitespace(self):
+        self.assertSplitsLikeReference("x" * 350, 100)
+        self.assertSplitsLikeReference("  " + "a" * 80 + " " + "a" * 19 + "  ", 100)
+        self.assertSplitsLikeReference("word " * 100 + "\n\n\n   ", 100)
+
+    def test_random_texts(self):
+        rng = random.Random(0)
+        alphabet = "ab .!?\n"
+        for _ in range(500):
+            text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 400)))
+            max_length = rng.randint(5, 120)
+            self.assertSplitsLikeReference(text, max_length)
+
+class TestSplitCodeIntoParts(unittest.TestCase):
+    def assertRejoins(self, code, max_length):
+        parts = split_code_into_parts(code, max_length)
+        self.assertEqual("".join(parts), code)
+        self.assertTrue(all(0 < len(part) <= max_length for part in parts))
+        return parts
+
+    def test_breaks_only_at_line_ends(self):
+        code = "def f():\n    # compute it. then return\n    x = 1\n    return x\n" * 20
+        parts = self.assertRejoins(code, 100)
+        self.assertGreater(len(parts), 1)
+        self.assertTrue(all(part.endswith("\n") for part in parts))
+
+    def test_indentation_is_kept(self):
+        code = "".join(f"    x{i} = compute(alpha, beta, gamma, delta)\n" for i in range(200))
+        parts = self.assertRejoins(code, 3500)
+        self.assertTrue(all(part.startswith("    x") for part in parts))
+
+    def test_long_line_is_hard_cut(self):
+        self.assertRejoins("a = 1\n" + "b" * 250 + "\nc = 2", 100)
+
+    def test_short_and_empty_code(self):
+        self.assertEqual(split_code_into_parts("", 100), [])
+        self.assertEqual(split_code_into_parts("  x = 1  \n", 100), ["  x = 1  \n"])
+
+    def test_random_code(self):
+        rng = random.Random(0)
+        alphabet = "ab .\n\t"
+        for _ in range(500):
+            code = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 400)))
+            self.assertRejoins(code, rng.randint(1, 120))
+
+class TestExtractFencedCode(unittest.TestCase):
+    def test_language_specifier_is_dropped(self):
+        self.assertEqual(extract_fenced_code("```python\nprint(1)\n```"), "print(1)\n")
+        self.assertEqual(extract_fenced_code("```c++\nint x;\n```"), "int x;\n")
+        self.assertEqual(extract_fenced_code("```\nprint(1)\n```"), "print(1)\n")
+
+    def test_spaces_after_specifier(self):
+        self.assertEqual(extract_fenced_code("```python  \nprint(1)\n```"), "print(1)\n")
+        self.assertEqual(extract_fenced_code("```python\r\nprint(1)\r\n```"), "print(1)\r\n")
+
+    def test_code_on_the_opening_line_is_kept(self):
+        self.assertEqual(extract_fenced_code("```x = 1\ny = 2\n```"), "x = 1\ny = 2\n")
+        self.assertEqual(extract_fenced_code("```print(1)```"), "print(1)")
+
+    def test_first_block_is_taken(self):
+        text = "Fix this:\n```py\na()\n```\nand this:\n```py\nb()\n```"
+        self.assertEqual(extract_fenced_code(text), "a()\n")
+
+    def test_no_closed_block(self):
+        self.assertIsNone(extract_fenced_code("plain text"))
+        self.assertIsNone(extract_fenced_code("```python\nprint(1)"))
+
+    def test_indentation_is_kept(self):
+        self.assertEqual(extract_fenced_code("```python\n    return 1\n```"), "    return 1\n")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,9 @@
+import atexit
 import logging
+import queue
 import sys
 import os
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 def setup_logger():
     logger = logging.getLogger("opencode_bot")
@@ -19,19 +21,26 @@ def setup_logger():
     # Console handler
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
     
     # File handler for bot.log
     log_file = os.path.join(os.path.dirname(os.path.dirname(__file__)), "bot.log")
     file_handler = RotatingFileHandler(log_file, maxBytes=10*1024*1024, backupCount=5)
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
     
     # File handler for debug log
     debug_log_file = os.path.join(os.path.dirname(os.path.dirname(__file__)), "bot_debug.log")
     debug_handler = RotatingFileHandler(debug_log_file, maxBytes=10*1024*1024, backupCount=2)
     debug_handler.setLevel(logging.DEBUG)
     debug_handler.setFormatter(formatter)
-    logger.addHandler(debug_handler)
+    
+    # Handlers write from a background thread; log calls only enqueue the record
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(
+        log_queue, console_handler, file_handler, debug_handler,
+        respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)
+    logger.addHandler(QueueHandler(log_queue))
     
     return logger
@@ -0,0 +1,94 @@
+"""
+Outbound Telegram rate limiting (antiflood) for bot API calls.
+Serializes sends per chat, enforces the bot-wide and group-chat message
+budgets and honours RetryAfter.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List
+
+from aiogram.exceptions import TelegramRetryAfter
+
+logger = logging.getLogger("opencode_bot")
+
+# Telegram allows about 30 messages per second bot-wide and 20 per minute in a group
+GLOBAL_CREDITS = 30
+GLOBAL_REFUND_TIME = 1.0  # seconds before a spent credit is returned
+GROUP_MESSAGES_PER_MINUTE = 20
+MAX_RETRIES = 3
+
+_global_credits = asyncio.Semaphore(GLOBAL_CREDITS)
+# Per-chat send lock and the number of senders holding or waiting on it:
+# {chat_id: [semaphore, users]}; dropped when the last sender leaves
+_chat_semaphores: Dict[int, List[Any]] = {}
+# Send timestamps of the last GROUP_MESSAGES_PER_MINUTE messages per group chat,
+# ordered by last send so histories older than a minute can be dropped from the front
+_group_history: "OrderedDict[int, Deque[float]]" = OrderedDict()
+
+
+async def _spend_global_credit() -> None:
+    """Take one credit from the bot-wide budget; it is refunded after GLOBAL_REFUND_TIME."""
+    await _global_credits.acquire()
+    asyncio.get_running_loop().call_later(GLOBAL_REFUND_TIME, _global_credits.release)
+
+
+async def _wait_group_slot(chat_id: int) -> None:
+    """Delay a send to a group chat until it is within the per-minute budget."""
+    if chat_id >= 0:  # private chats have no per-minute cap
+        return
+    history = _group_history.get(chat_id)
+    if history is None:
+        _evict_idle_groups()
+        history = _group_history[chat_id] = deque(maxlen=GROUP_MESSAGES_PER_MINUTE)
+    if len(history) == history.maxlen:
+        delay = history[0] + 60.0 - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    history.append(time.monotonic())
+    _group_history.move_to_end(chat_id)
+
+
+def _evict_idle_groups() -> None:
+    """Drop histories of groups that have sent nothing for a minute; they no longer limit anything."""
+    cutoff = time.monotonic() - 60.0
+    while _group_history:
+        chat_id, history = next(iter(_group_history.items()))
+        if history and history[-1] > cutoff:
+            break
+        del _group_history[chat_id]
+
+
+async def send(coro_factory: Callable[[], Awaitable[Any]], chat_id: int) -> Any:
+    """
+    Run a Telegram API call under per-chat and global limits.
+
+    Args:
+        coro_factory: Zero-argument callable creating the API call coroutine
+            (called again on each retry, since a coroutine can only be awaited once)
+        chat_id: Chat the call targets
+
+    Returns:
+        Result of the API call
+    """
+    entry = _chat_semaphores.get(chat_id)
+    if entry is None:
+        entry = _chat_semaphores[chat_id] = [asyncio.Semaphore(1), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            for attempt in range(MAX_RETRIES):
+                await _wait_group_slot(chat_id)
+                await _spend_global_credit()
+                try:
+                    return await coro_factory()
+                except TelegramRetryAfter as e:
+                    if attempt == MAX_RETRIES - 1:
+                        raise
+                    logger.warning(f"Flood control for chat {chat_id}, retrying in {e.retry_after}s")
+                    await asyncio.sleep(e.retry_after)
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _chat_semaphores[chat_id]
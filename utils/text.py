@@ -0,0 +1,66 @@
+"""
+Plain-text helpers shared by the bot handlers.
+"""
+import re
+from typing import Optional
+
+_LEADING_WHITESPACE_RE = re.compile(r'\s*')
+# First fenced code block; an opening line holding only a language specifier
+# (possibly followed by spaces) is not captured
+_FENCE_RE = re.compile(r'```(?:[\w+#.-]*[^\S\n]*\n)?(.*?)```', re.DOTALL)
+# Break points in order of preference
+_SEPARATORS = ('. ', '! ', '? ', '\n\n', '\n', ' ')
+
+def split_text_into_parts(text, max_length=3500):
+    """Split text into parts, trying to break at sentence boundaries."""
+    parts = []
+    start, end = 0, len(text)
+    while end - start > max_length:
+        # Find a good breaking point, using at least 70% of the limit
+        limit = start + max_length
+        split_at = limit
+        for separator in _SEPARATORS:
+            pos = text.rfind(separator, start, limit)
+            if pos - start > max_length * 0.7:
+                split_at = pos + len(separator)
+                break
+
+        part = text[start:split_at].strip()
+        if part:
+            parts.append(part)
+        if start == 0:
+            # The remainder after a split is stripped on both sides
+            end = len(text.rstrip())
+        start = _LEADING_WHITESPACE_RE.match(text, split_at).end()
+
+    if start < end:
+        parts.append(text[start:end])
+    return parts
+
+def extract_fenced_code(text: str) -> Optional[str]:
+    """Return the first ``` fenced block without its language line, or None if no block is closed.
+
+    The first line is dropped only when it is a language specifier, so code written on the
+    opening fence line is kept. The block is returned as written; callers decide on stripping.
+    """
+    match = _FENCE_RE.search(text)
+    return match.group(1) if match else None
+
+def split_code_into_parts(code, max_length=3500):
+    """Split code into parts of at most max_length characters at line ends, without stripping.
+
+    Each part keeps its trailing newline, so "".join(parts) == code; only a line longer
+    than max_length is cut in the middle.
+    """
+    parts = []
+    start = 0
+    while len(code) - start > max_length:
+        limit = start + max_length
+        newline = code.rfind('\n', start, limit)
+        split_at = newline + 1 if newline != -1 else limit
+        parts.append(code[start:split_at])
+        start = split_at
+
+    if start < len(code):
+        parts.append(code[start:])
+    return parts